@@ -0,0 +1,212 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import graph_clients
+import position_handler
+import synthetic_data
+from graph_clients import SushiswapFarmsClient
+from position_handler import PositionHandler, WETH, order_positions
+from price_helper import PriceProvider, SUSHISWAP_ENDPOINT
+from price_store import PriceStore
+from snapshot_index import SnapshotIndex
+from token_store import TokenStore
+
+# Results of every scale are stored in their own file, so a regression shows up as a diff between runs
+RESULTS_DIR = "benchmarks/"
+DEFAULT_SCALES = ["1k", "10k", "100k"]
+
+
+class StubPriceProvider:
+    """Prices made up from token and block, so that stages using prices are measured without pricing itself."""
+
+    def __init__(self, tokens):
+        self._tokens = tokens
+
+    def decimals(self, token):
+        token = self._tokens.get(token)
+        return token["decimals"] if token is not None else None
+
+    def prefetchTokens(self, token_addresses):
+        pass
+
+    def prefetchPriceSnapshots(self, token_blocks):
+        pass
+
+    def getEthPriceinUSDForBlocks(self, blocks, messages=None):
+        return {block: self._price(WETH, block) for block in set(blocks)}
+
+    def getTokenPriceinUSDForBlocks(self, token, blocks, eth_prices, messages=None):
+        return {block: self._price(token, block) for block in set(blocks)}
+
+    def _price(self, token, block):
+        return (1 + int(token[2:8], 16) % 1000) * (1 + block % 1000 / 10000)
+
+
+class SyntheticPriceProvider(PriceProvider):
+    """Price provider computing prices from synthetic snapshots, with price and token stores in directory."""
+
+    def __init__(self, data, indexes, directory):
+        super().__init__(PriceStore(os.path.join(directory, "prices.sqlite")), TokenStore(os.path.join(directory, "tokens.sqlite")))
+        self._token_store.putTokens(data.tokens)
+        for market, (token, _) in data.markets.items():
+            self._weth_pairs[token] = market
+        self._indexes = indexes
+
+    def getMarketSnapshotsForBlocks(self, market, blocks):
+        return self._indexes[market].lookup(blocks)
+
+    def prefetchPriceSnapshots(self, token_blocks):
+        pass
+
+
+def snapshot_indexes(data):
+    """Snapshot index of every market holding all its synthetic snapshots."""
+
+    indexes = {}
+    for market, snapshots in data.snapshots.items():
+        index = SnapshotIndex(None, market)
+        index._add(snapshots)
+        # snapshots are the whole history of the market, nothing is ever fetched
+        index._cover(0, 2 ** 62)
+        indexes[market] = index
+    return indexes
+
+
+def measure(function, memory=True):
+    """Run function and return its output, seconds and peak memory in bytes.
+    Peak memory is measured by a second run under tracemalloc, which would distort the time of the first one.
+    """
+
+    # progress messages of the stages would bury the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        output = function()
+        seconds = time.perf_counter() - start_time
+
+        peak_memory = None
+        if memory:
+            tracemalloc.start()
+            try:
+                function()
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return output, seconds, peak_memory
+
+
+def run_benchmark(transactions, seed=0, memory=True):
+    """Run all the compute stages on synthetic data with given number of pool transactions.
+    Return dict of results, with seconds, peak memory and output size of every stage.
+    """
+
+    print("Generating {0} transactions...".format(transactions))
+    data = synthetic_data.generate(transactions, seed)
+    indexes = snapshot_indexes(data)
+
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    stub = StubPriceProvider(data.tokens)
+    patched = (position_handler.PriceProvider, position_handler.token_store, graph_clients.PriceProvider)
+    position_handler.PriceProvider = graph_clients.PriceProvider = lambda: stub
+    position_handler.token_store = TokenStore(os.path.join(directory, "tokens.sqlite"))
+
+    try:
+        handler = PositionHandler(SUSHISWAP_ENDPOINT)
+        farm_client = SushiswapFarmsClient()
+
+        def price_tokens(merged_positions):
+            provider = SyntheticPriceProvider(data, indexes, tempfile.mkdtemp(dir=directory))
+            token_blocks = handler._planTokenPrices(merged_positions)
+            eth_prices = provider.getEthPriceinUSDForBlocks(set().union(*token_blocks.values()))
+            return handler._fetchTokenPrices(provider, token_blocks, eth_prices)
+
+        def pool_profitability(merged_positions, farm_transactions):
+            by_market = {}
+            for position_id, txs in merged_positions.items():
+                market = position_id.split("-")[1]
+                if market not in by_market: by_market[market] = {}
+                by_market[market][position_id] = txs
+
+            stats = {}
+            for positions in by_market.values():
+                stats.update(handler.calculateProfitabilityOfPoolPositions(positions, farm_transactions))
+            return stats
+
+        stages = [
+            ("parse_positions", lambda: order_positions(handler._parseRawPositions(data.positions)), []),
+            ("parse_farm_positions", lambda: farm_client._parseFarmPositions(data.farm_positions, with_market=True), []),
+            ("merge_positions", handler.mergePositionsByHistory, ["parse_positions"]),
+            ("join_farm_transactions", lambda farm_transactions, merged_positions: farm_client.getFarmTransactionsForAllPositions(
+                data.farms, farm_transactions, merged_positions), ["parse_farm_positions", "merge_positions"]),
+            ("reward_values", farm_client.addRewardValueInUSD, ["join_farm_transactions"]),
+            ("token_prices", price_tokens, ["merge_positions"]),
+            ("pool_profitability", pool_profitability, ["merge_positions", "reward_values"]),
+            ("all_profitability", handler.calculateProfitabilityOfAllPositions, ["merge_positions", "reward_values"]),
+        ]
+
+        outputs = {}
+        results = {}
+        for name, function, inputs in stages:
+            args = [outputs[input_name] for input_name in inputs]
+            output, seconds, peak_memory = measure(lambda: function(*args), memory)
+            outputs[name] = output
+            results[name] = {"seconds": round(seconds, 3), "peak_memory_mb": _megabytes(peak_memory), "output_size": len(output)}
+            print("{0:<24} {1:>9.3f}s {2!s:>10} MB {3:>10}".format(name, seconds, results[name]["peak_memory_mb"], len(output)))
+    finally:
+        position_handler.PriceProvider, position_handler.token_store, graph_clients.PriceProvider = patched
+        shutil.rmtree(directory)
+
+    return {
+        "transactions": data.transactionCount(),
+        "positions": len(data.positions),
+        "farm_positions": len(data.farm_positions),
+        "seed": seed,
+        "python": platform.python_version(),
+        "stages": results,
+    }
+
+
+def save_results(scale, results):
+    """Write results of scale and print change of every stage against the previous results."""
+
+    path = os.path.join(RESULTS_DIR, "{0}.json".format(scale))
+    if os.path.isfile(path):
+        with open(path) as f:
+            previous = json.load(f)
+        for name, stage in results["stages"].items():
+            previous_stage = previous["stages"].get(name)
+            if previous_stage and previous_stage["seconds"]:
+                change = (stage["seconds"] - previous_stage["seconds"]) / previous_stage["seconds"]
+                print("{0:<24} {1:>+8.0%} time vs previous run".format(name, change))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to {0}".format(path))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark compute stages on synthetic positions.")
+    parser.add_argument("scales", nargs="*", default=DEFAULT_SCALES, help="numbers of pool transactions, ie. 1k 100k 10m")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory measurement, which runs every stage twice")
+    args = parser.parse_args()
+
+    for scale in args.scales:
+        print("\nScale {0}".format(scale))
+        save_results(scale, run_benchmark(synthetic_data.parse_scale(scale), args.seed, not args.no_memory))
+
+
+def _megabytes(size):
+    return round(size / 2 ** 20, 1) if size is not None else None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import shutil
+import sys
+import tempfile
+import threading
+
+from aiohttp import web
+
+import pagination
+import synthetic_data
+from metrics import metrics, REQUESTS
+from pagination import Paginator
+from query_cache import QueryCache, CACHE_TTL, CACHE_MAX_SIZE
+from subgraph_client import GraphClient
+from subgraph_server import SubgraphServer, Fixtures, PATH_PREFIX
+
+# Scan checked against the cache, its pages adapt to response size
+QUERY = "queries/get_all_raw_closed_positions.graphql"
+ENTITY = "positions"
+DEFAULT_SCALE = "100k"
+# Small target, so page sizes of the scan shrink after the first pages
+DEFAULT_TARGET_PAGE_BYTES = 100 * 1024
+
+
+def start_server(server):
+    """Serve the stand-in on a free local port from a background thread. Return its endpoint for sushiswap subgraph."""
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="subgraph-server", daemon=True).start()
+
+    async def start():
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        return runner.addresses[0][1]
+
+    port = asyncio.run_coroutine_threadsafe(start(), loop).result()
+    return "http://127.0.0.1:{0}{1}sushiswap".format(port, PATH_PREFIX)
+
+
+def scan(endpoint, cache, stream=False):
+    """Run the sharded scan with cache. Return IDs of the rows and number of requests sent for the query."""
+
+    metrics.reset()
+    paginator = Paginator(GraphClient(endpoint, cache))
+    if stream:
+        rows = [row for page in paginator.iterShardedScan(QUERY, ENTITY, {}) for row in page]
+    else:
+        rows = paginator.shardedScan(QUERY, ENTITY, {})
+
+    requests = sum(stage["queries"].get("get_all_raw_closed_positions.graphql", {}).get(REQUESTS, 0)
+                   for stage in metrics.summary()["stages"].values())
+    return [row["id"] for row in rows], requests
+
+
+def run_check(transactions, seed=0, target_page_bytes=DEFAULT_TARGET_PAGE_BYTES):
+    """Scan the stand-in into an empty cache, then scan it again warm, replay only and streaming replay only.
+    Return list of failures, empty if every re-run was served from the cache without a request.
+    """
+
+    pagination.TARGET_PAGE_BYTES = target_page_bytes
+    endpoint = start_server(SubgraphServer(Fixtures.fromSyntheticData(synthetic_data.generate(transactions, seed))))
+    directory = tempfile.mkdtemp(prefix="cache-check-")
+    try:
+        ids, requests = scan(endpoint, QueryCache(directory, CACHE_TTL, CACHE_MAX_SIZE))
+        print("{0:<24} {1:>8} rows {2:>6} requests".format("cold", len(ids), requests))
+
+        failures = []
+        runs = [
+            ("warm", QueryCache(directory, CACHE_TTL, CACHE_MAX_SIZE), False),
+            ("replay only", QueryCache(directory, CACHE_TTL, CACHE_MAX_SIZE, replay_only=True), False),
+            ("replay only streaming", QueryCache(directory, CACHE_TTL, CACHE_MAX_SIZE, replay_only=True), True),
+        ]
+        for name, cache, stream in runs:
+            try:
+                run_ids, run_requests = scan(endpoint, cache, stream)
+            except Exception as error:
+                failures.append("{0}: {1!r}".format(name, error))
+                continue
+            print("{0:<24} {1:>8} rows {2:>6} requests".format(name, len(run_ids), run_requests))
+            if run_requests:
+                failures.append("{0}: {1} requests sent".format(name, run_requests))
+            if run_ids != ids:
+                failures.append("{0}: rows differ from the cold scan".format(name))
+        return failures
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that re-runs of a paginated scan are served from the query cache.")
+    parser.add_argument("scale", nargs="?", default=DEFAULT_SCALE, help="number of pool transactions of the stand-in, ie. 100k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target-page-bytes", type=int, default=DEFAULT_TARGET_PAGE_BYTES)
+    args = parser.parse_args()
+
+    failures = run_check(synthetic_data.parse_scale(args.scale), args.seed, args.target_page_bytes)
+    for failure in failures:
+        print("FAILED " + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import asyncio
+import atexit
+import threading
+
+import aiohttp
+from gql import Client
+from gql.transport.aiohttp import AIOHTTPTransport
+
+from transport import response_size_trace
+
+# Max number of open connections per endpoint
+POOL_SIZE = 16
+# Seconds an idle connection is kept open for reuse
+KEEPALIVE_TIMEOUT = 60
+EXECUTE_TIMEOUT = 120
+
+class ConnectionPool:
+    """Connected gql sessions shared by all subgraph clients, one session per endpoint.
+    Sessions live on a background event loop and are created on first use, so nothing is started on import
+    and TCP/TLS connections stay warm across clients and pools.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT):
+        self._pool_size = pool_size
+        self._keepalive_timeout = keepalive_timeout
+        self._loop = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._connect_lock = None
+        self._clients = {}
+        self._sessions = {}
+
+    def run(self, coroutine):
+        """Run coroutine on the pool's event loop and block until it's done.
+        Must not be called from the pool's event loop itself.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._getLoop()).result()
+
+    async def session(self, endpoint):
+        """Return connected session for endpoint. Has to be awaited on the pool's event loop."""
+
+        session = self._sessions.get(endpoint)
+        if session is not None:
+            return session
+
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if endpoint not in self._sessions:
+                connector = aiohttp.TCPConnector(limit=self._pool_size, keepalive_timeout=self._keepalive_timeout)
+                transport = AIOHTTPTransport(url=endpoint, client_session_args={"connector": connector, "trace_configs": [response_size_trace()]})
+                client = Client(transport=transport, execute_timeout=EXECUTE_TIMEOUT)
+                self._sessions[endpoint] = await client.connect_async()
+                self._clients[endpoint] = client
+
+        return self._sessions[endpoint]
+
+    def close(self):
+        """Close all the sessions and stop the event loop."""
+
+        with self._thread_lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._closeSessions(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+            self._connect_lock = None
+
+    async def _closeSessions(self):
+        for client in self._clients.values():
+            await client.close_async()
+        self._clients = {}
+        self._sessions = {}
+
+    def _getLoop(self):
+        with self._thread_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="connection-pool", daemon=True)
+                self._thread.start()
+            return self._loop
+
+
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close)
@@ -1,6 +1,7 @@
 #%%
 # Load position data
 import pandas as pd
+from stats_dataset import load_stats
 
 DATASET_NAME = "TOP20-TVL"
 
@@ -8,7 +9,8 @@ FOLDER = "stats/top20-tvl-stats/"
 FILE_NAME = FOLDER + "top20tvl-combined.csv"
 PLOTS = FOLDER + "plots/"
 
-df = pd.read_csv(FILE_NAME, parse_dates=["position_end_date", "position_start_date"])
+# Parquet dataset of the folder is memory mapped if it exists, otherwise combined CSV is parsed
+df = load_stats(FOLDER, FILE_NAME)
 df.head(10)
 
 # %%
@@ -1,9 +1,31 @@
-from position_handler import PositionHandler
-from graph_clients import SushiswapFarmsClient
+from position_handler import PositionHandler, MASTERCHEFS, index_positions, parse_position_id
+from graph_clients import SushiswapFarmsClient, FarmTransactionStream, SUSHISWAP_FARMS_ENDPOINT
+from price_helper import PriceProvider, SUSHISWAP_ENDPOINT
+from pipeline import Pipeline, Stage
+from metrics import metrics
 import os.path
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import shutil
+import stats_dataset
+import transport
+import price_router
+import snapshot_index
 
-SUSHISWAP_ENDPOINT = "https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap"
-SUSHISWAP_FARMS_ENDPOINT = "https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap-farms"
+# Max number of subgraph requests in flight when scanning multiple pools
+SCAN_CONCURRENCY = 8
+
+# Number of ID ranges scanned in parallel when fetching positions of all pools
+ALL_POSITIONS_SHARDS = 16
+
+# Number of merged positions priced together when streaming all positions, memory of the run depends on it
+STREAM_BATCH_SIZE = 1000
+
+# Write stats also as Parquet dataset partitioned by market, next to CSV files (requires pyarrow)
+WRITE_PARQUET = True
 
 pools = {}
 pools["DAI_WETH"] = "0xc3d03e4f041fd4cd388c549ee2a29a9e5075882f"
@@ -41,53 +63,259 @@ pools['SNX_WETH'] = "0xa1d7b2d891e3a1f9ef4bbc5be20630c2feb1c470"
 pools['MKR_WETH'] = "0xba13afecda9beb75de5c56bbaf696b880a5a50dd"
 pools['UNI_WETH'] = "0xdafd66636e2561b0284edde37e42d192f2844d40"
 
-
-def collect_data_for(pool, filename):
+# Pool lists by name, every list is stored in its own folder as (folder, pool names)
+POOL_LISTS = {}
+POOL_LISTS["top20-tvl"] = ("stats/top20-tvl-stats/", [
+    'ILV_WETH',
+    'USDC_WETH',
+    'OHM_DAI',
+    'USDT_WETH',
+    'WBTC_WETH',
+    'OHM_WETH',
+    'SUSHI_WETH',
+    'BIT_WETH',
+    'TOKE_WETH',
+    'ALCX_WETH',
+    'AAVE_WETH',
+    'DAI_WETH',
+    'PUNK_WETH',
+    'WXRP_WETH',
+    'YFI_WETH'
+])
+POOL_LISTS["top20-volume"] = ("stats/top20-volume-stats/", [
+    'CRV_WETH',
+    'ALCX_WETH',
+    'RADAR_WETH',
+    'METIS_WETH',
+    'OHM_WETH',
+    'DAI_WETH',
+    'SUSHI_WETH',
+    'YGG_WETH',
+    'KP3R_WETH',
+    'YFI_WETH',
+    'UST_WETH',
+    'WBTC_WETH',
+    'SPELL_WETH',
+    'BOND_WETH',
+    'AAVE_WETH',
+    'REN_WETH',
+    'CREAM_WETH',
+    'COMP_WETH'
+])
+POOL_LISTS["defi"] = ("stats/defi-pools-stats/", [
+    'CRV_WETH',
+    'SUSHI_WETH',
+    'YFI_WETH',
+    'AAVE_WETH',
+    'COMP_WETH',
+    'CVX_WETH',
+    'SNX_WETH',
+    'MKR_WETH',
+    'UNI_WETH'
+])
+POOL_LISTS["stablecoin"] = ("stats/stablecoin-pools-stats/", [
+    'USDC_WETH',
+    'USDT_WETH',
+    'DAI_WETH'
+])
+
+# Code which outputs of pipeline stages depend on, changing it invalidates stored outputs of the stage and stages after it
+PRICE_CODE = [PriceProvider, snapshot_index, price_router]
+MERGE_CODE = [PositionHandler.mergePositionsByHistory, PositionHandler.iterMergedPositions, index_positions, parse_position_id]
+FARM_CODE = [
+    SushiswapFarmsClient._indexFarmTransactions,
+    SushiswapFarmsClient._joinFarmTransactions,
+    SushiswapFarmsClient.getFarmTransactionsForPositions,
+    SushiswapFarmsClient.getFarmTransactionsForAllPositions,
+    SushiswapFarmsClient.addRewardValueInUSD,
+    SushiswapFarmsClient.rewardAmounts,
+] + PRICE_CODE
+POSITION_VALUE_CODE = [PositionHandler._sumInvestments, PositionHandler._sumRedemptions, PositionHandler._getPositionTimestamps] + PRICE_CODE
+POOL_PROFITABILITY_CODE = [PositionHandler.calculateProfitabilityOfPoolPositions] + POSITION_VALUE_CODE
+ALL_PROFITABILITY_CODE = [PositionHandler.calculateProfitabilityOfAllPositions] + POSITION_VALUE_CODE
+
+# Stats of every pool are computed once into this folder and then copied to folders of pool lists
+SHARED_STATS_FOLDER = "stats/pools/"
+
+# Number of pools collected in parallel by separate processes
+WORKERS = 4
+
+
+def collect_data_for(pool, filename, raw_positions=None, farm_data=None):
+    """Collect profitability stats for pool and write them to filename.
+    Raw positions and farm data (farm market ID, farm transactions) are fetched here unless already prefetched.
+    Outputs of all the stages are stored, so a failed run resumes from the failed stage.
+    Metrics of the run are written next to filename.
+    """
     position_handler = PositionHandler(SUSHISWAP_ENDPOINT)
 
-    raw_positions = position_handler.getRawClosedPositions(pool)
-    print("Positions loaded from subgraph: {0}".format(len(raw_positions)))
+    # prefetched data is used in place of the fetching stages
+    outputs = {}
+    if raw_positions is not None:
+        outputs["raw_positions"] = raw_positions
+    if farm_data is not None:
+        outputs["farm_data"] = farm_data
+
+    profitability_stats = pool_pipeline(pool, position_handler).run("profitability_stats", outputs)
+    print("Profitability stats ready")
+
+    write_stats(position_handler, profitability_stats, filename)
+    print("Stats written to {0}".format(filename))
+    export_metrics(filename)
+
+
+def export_metrics(filename):
+    """Write metrics recorded since the last export next to stats file and start recording anew."""
+    metrics.export(filename)
+    metrics.reset()
+
+
+def pool_pipeline(pool, position_handler):
+    """Stages of collecting stats of a pool."""
 
-    merged_positions = position_handler.mergePositionsByHistory(raw_positions)
-    print("Positions after merging histories: {0}".format(len(merged_positions)))
+    def fetch_raw_positions():
+        raw_positions = position_handler.getRawClosedPositions(pool)
+        print("Positions loaded from subgraph: {0}".format(len(raw_positions)))
+        return raw_positions
+
+    def merge_positions(raw_positions):
+        merged_positions = position_handler.mergePositionsByHistory(raw_positions)
+        print("Positions after merging histories: {0}".format(len(merged_positions)))
+        return merged_positions
 
     # Call farm data to get farm transactions list here
     # We can optimize it by fetching farm data and sending it to mergePositionByHistory to reduce number of loops
-    farm_transactions = collect_data_for_farms(pool, merged_positions)
-    print("Farm transactions for merged positions: {0}".format(len(farm_transactions)))
+    def match_farm_transactions(merged_positions, farm_data):
+        farm_transactions = collect_data_for_farms(pool, merged_positions, farm_data)
+        print("Farm transactions for merged positions: {0}".format(len(farm_transactions)))
+        return farm_transactions
+
+    def calculate_profitability(merged_positions, farm_transactions):
+        print("Calculating profitability...")
+        return position_handler.calculateProfitabilityOfPoolPositions(merged_positions, farm_transactions)
+
+    return Pipeline("pool-" + pool, [
+        Stage("raw_positions", fetch_raw_positions, config={"endpoint": SUSHISWAP_ENDPOINT, "pool": pool}, volatile=True),
+        Stage("merged_positions", merge_positions, ["raw_positions"], MERGE_CODE, {"MASTERCHEFS": MASTERCHEFS}),
+        Stage("farm_data", lambda: fetch_farm_data_for(pool), config={"endpoint": SUSHISWAP_FARMS_ENDPOINT, "pool": pool}, volatile=True),
+        Stage("farm_transactions", match_farm_transactions, ["merged_positions", "farm_data"], FARM_CODE + [collect_data_for_farms]),
+        Stage("profitability_stats", calculate_profitability, ["merged_positions", "farm_transactions"], POOL_PROFITABILITY_CODE),
+    ], head_block=get_head_block)
+
+
+def fetch_farm_data_for(pool):
+    """Return (farm market ID, farm transactions) of pool, both are None if pool has no farm."""
+    farm_client = SushiswapFarmsClient()
+    market_id = farm_client.getMarketForLPToken(pool)
+    if market_id == None:
+        return None, None
+    return market_id, farm_client.getTransactionsOfClosedPositions(market_id)
+
+
+def write_stats(position_handler, profitability_stats, filename, append=False):
+    """Write stats to CSV file and, if enabled, to Parquet dataset of the folder."""
+    position_handler.writeProfitabilityStatsToCsv(profitability_stats, filename, append)
+    if WRITE_PARQUET and stats_dataset.is_available():
+        position_handler.writeProfitabilityStatsToParquet(profitability_stats, stats_dataset.dataset_folder(filename), append)
 
-    print("Calculating profitability...")
-    profitability_stats = position_handler.calculateProfitabilityOfPoolPositions(merged_positions, farm_transactions)
+
+def collect_data_for_alls():
+    position_handler = PositionHandler(SUSHISWAP_ENDPOINT)
+
+    profitability_stats = all_positions_pipeline(position_handler).run("profitability_stats")
     print("Profitability stats ready")
 
-    position_handler.writeProfitabilityStatsToCsv(profitability_stats, filename)
+    filename = "stats/all-positions.csv"
+    write_stats(position_handler, profitability_stats, filename)
     print("Stats written to {0}".format(filename))
+    export_metrics(filename)
 
 
-def collect_data_for_alls():
+def stream_data_for_alls(filename="stats/all-positions.csv", batch_size=STREAM_BATCH_SIZE):
+    """Collect stats of all positions in ETH markets with memory bounded by batch size rather than number of positions.
+    Positions are read page by page, merged as soon as their account/market chains are complete and priced
+    in batches; stats of every batch are written right away. Outputs aren't stored, a failed run starts over.
+    """
     position_handler = PositionHandler(SUSHISWAP_ENDPOINT)
+    farm_client = SushiswapFarmsClient()
+    price_provider = PriceProvider()
+
+    farm_stream = FarmTransactionStream(farm_client, farm_client.getAllMarkets(), farm_client.iterTransactionsOfAllClosedPositions(ALL_POSITIONS_SHARDS))
+    merged_positions = position_handler.iterAllMergedPositions(ALL_POSITIONS_SHARDS)
+    parquet_writer = stats_dataset.StatsWriter(stats_dataset.dataset_folder(filename)) if WRITE_PARQUET and stats_dataset.is_available() else None
+
+    positions_count = 0
+    stats_count = 0
+    while True:
+        with metrics.stage("merged_positions"):
+            positions = dict(itertools.islice(merged_positions, batch_size))
+        if not positions:
+            break
+
+        with metrics.stage("farm_transactions"):
+            farm_transactions = farm_stream.getFarmTransactions(positions)
+        with metrics.stage("profitability_stats"):
+            profitability_stats = position_handler.calculateProfitabilityOfAllPositions(positions, farm_transactions, price_provider)
+
+        position_handler.writeProfitabilityStatsToCsv(profitability_stats, filename, append=positions_count > 0)
+        if parquet_writer is not None:
+            parquet_writer.write(profitability_stats)
+        # snapshots of markets the next batches don't price are dropped, they grow with the history of the protocol
+        snapshot_index.evict_indexes()
+        positions_count += len(positions)
+        stats_count += len(profitability_stats)
+        print("Stats written for {0} of {1} merged positions".format(stats_count, positions_count))
+
+    if positions_count == 0:
+        position_handler.writeProfitabilityStatsToCsv({}, filename)
+    if parquet_writer is not None:
+        parquet_writer.flush()
+    print("Stats written to {0}".format(filename))
+    export_metrics(filename)
 
-    raw_positions = position_handler.getAllRawClosedPositions()
-    print("Positions loaded from subgraph: {0}".format(len(raw_positions)))
 
-    merged_positions = position_handler.mergePositionsByHistory(raw_positions)
-    print("Positions after merging histories: {0}".format(len(merged_positions)))
+def all_positions_pipeline(position_handler):
+    """Stages of collecting stats of all positions in ETH markets."""
 
-    farm_transactions = collect_data_for_all_farms(merged_positions)
-    print("Farm transactions for merged positions: {0}".format(len(farm_transactions)))
+    def fetch_raw_positions():
+        raw_positions = position_handler.getAllRawClosedPositions(ALL_POSITIONS_SHARDS)
+        print("Positions loaded from subgraph: {0}".format(len(raw_positions)))
+        return raw_positions
 
-    print("Calculating profitability...")
-    profitability_stats = position_handler.calculateProfitabilityOfAllPositions(merged_positions, farm_transactions)
-    print("Profitability stats ready")
+    def merge_positions(raw_positions):
+        merged_positions = position_handler.mergePositionsByHistory(raw_positions)
+        print("Positions after merging histories: {0}".format(len(merged_positions)))
+        return merged_positions
 
-    filename = "stats/all-positions.csv"
-    position_handler.writeProfitabilityStatsToCsv(profitability_stats, filename)
-    print("Stats written to {0}".format(filename))
+    def fetch_farm_data():
+        farm_client = SushiswapFarmsClient()
+        return farm_client.getAllMarkets(), farm_client.getTransactionsOfAllClosedPositions(ALL_POSITIONS_SHARDS)
 
+    def match_farm_transactions(merged_positions, farm_data):
+        farm_transactions = collect_data_for_all_farms(merged_positions, farm_data)
+        print("Farm transactions for merged positions: {0}".format(len(farm_transactions)))
+        return farm_transactions
 
-def collect_data_for_farms(pool, positions):
+    def calculate_profitability(merged_positions, farm_transactions):
+        print("Calculating profitability...")
+        return position_handler.calculateProfitabilityOfAllPositions(merged_positions, farm_transactions)
+
+    return Pipeline("all-positions", [
+        Stage("raw_positions", fetch_raw_positions, config={"endpoint": SUSHISWAP_ENDPOINT}, volatile=True),
+        Stage("merged_positions", merge_positions, ["raw_positions"], MERGE_CODE, {"MASTERCHEFS": MASTERCHEFS}),
+        Stage("farm_data", fetch_farm_data, config={"endpoint": SUSHISWAP_FARMS_ENDPOINT}, volatile=True),
+        Stage("farm_transactions", match_farm_transactions, ["merged_positions", "farm_data"], FARM_CODE + [collect_data_for_all_farms]),
+        Stage("profitability_stats", calculate_profitability, ["merged_positions", "farm_transactions"], ALL_PROFITABILITY_CODE),
+    ], head_block=get_head_block)
+
+
+def collect_data_for_farms(pool, positions, farm_data=None):
     farm_client = SushiswapFarmsClient()
-    market_id = farm_client.getMarketForLPToken(pool)
+    if farm_data is None:
+        market_id = farm_client.getMarketForLPToken(pool)
+        farm_transactions = None
+    else:
+        market_id, farm_transactions = farm_data
     if market_id == None:
         return []
     print("Farm ID for pool: {0} is : {1}".format(market_id, pool))
@@ -95,150 +323,237 @@ def collect_data_for_farms(pool, positions):
     [farm_address, farm_id] = market_id.split("-")
     print("Farm Contract address: {0} and farm id : {1}".format(farm_address, farm_id))
 
-    farm_transactions = farm_client.getTransactionsOfClosedPositions(market_id)
+    if farm_transactions is None:
+        farm_transactions = farm_client.getTransactionsOfClosedPositions(market_id)
     farm_transactions_for_positions = farm_client.getFarmTransactionsForPositions(farm_address, farm_transactions, positions)
     farm_transactions_with_prices = farm_client.addRewardValueInUSD(farm_transactions_for_positions)
 
     return farm_transactions_with_prices
 
-def collect_data_for_all_farms(positions):
+def collect_data_for_all_farms(positions, farm_data=None):
     farm_client = SushiswapFarmsClient()
     
-    farms = farm_client.getAllMarkets()
-    farm_transactions = farm_client.getTransactionsOfAllClosedPositions()
+    if farm_data is None:
+        farm_data = farm_client.getAllMarkets(), farm_client.getTransactionsOfAllClosedPositions(ALL_POSITIONS_SHARDS)
+    farms, farm_transactions = farm_data
     farm_transactions_for_positions = farm_client.getFarmTransactionsForAllPositions(farms, farm_transactions, positions)
     farm_transactions_with_prices = farm_client.addRewardValueInUSD(farm_transactions_for_positions)
 
     return farm_transactions_with_prices
 
-def collect_top_20_by_tvl():
-    protocols = [
-        'ILV_WETH',
-        'USDC_WETH',
-        'OHM_DAI',
-        'USDT_WETH',
-        'WBTC_WETH',
-        'OHM_WETH',
-        'SUSHI_WETH',
-        'BIT_WETH',
-        'TOKE_WETH',
-        'ALCX_WETH',
-        'AAVE_WETH',
-        'DAI_WETH',
-        'PUNK_WETH',
-        'WXRP_WETH',
-        'YFI_WETH',
-    ]
+def collect_new_data_for(pool, filename, head_block=None):
+    """Collect stats of positions of pool closed since the last run and append them to filename.
+    Watermark of the last run is stored next to filename. Without it all the positions are collected
+    and filename is overwritten.
+    """
+    position_handler = PositionHandler(SUSHISWAP_ENDPOINT)
+    if head_block is None:
+        head_block = get_head_block()
+
+    watermark = load_watermark(filename)
+    since_block = watermark["block"] if watermark is not None else 0
+    pending = watermark["pending"] if watermark is not None else []
+    if head_block <= since_block:
+        print("Stats in {0} are up to date with block {1}".format(filename, since_block))
+        return
+
+    with metrics.stage("raw_positions"):
+        raw_positions = position_handler.getRawPositionsClosedSince(pool, since_block, head_block, pending)
+    print("Positions closed since block {0}: {1}, pending from previous run: {2}".format(since_block, len(raw_positions) - len(pending), len(pending)))
+
+    # positions whose history isn't complete yet are picked up again by the next run
+    incomplete = []
+    with metrics.stage("merged_positions"):
+        merged_positions = dict(position_handler.iterMergedPositions(raw_positions, incomplete=incomplete))
+    print("Positions after merging histories: {0}, waiting for history to complete: {1}".format(len(merged_positions), len(incomplete)))
+
+    profitability_stats = {}
+    if merged_positions:
+        with metrics.stage("farm_transactions"):
+            farm_transactions = collect_data_for_farms(pool, merged_positions, fetch_new_farm_data_for(pool, merged_positions, head_block))
+        print("Farm transactions for merged positions: {0}".format(len(farm_transactions)))
+
+        print("Calculating profitability...")
+        with metrics.stage("profitability_stats"):
+            profitability_stats = position_handler.calculateProfitabilityOfPoolPositions(merged_positions, farm_transactions)
+        print("Profitability stats ready")
+
+    write_stats(position_handler, profitability_stats, filename, append=watermark is not None)
+    save_watermark(filename, head_block, incomplete)
+    print("Stats written to {0}, up to date with block {1}".format(filename, head_block))
+    export_metrics(filename)
+
+def fetch_new_farm_data_for(pool, positions, head_block):
+    """Return (farm market ID, farm transactions) for positions collected incrementally.
+    Farm positions matching position histories were closed after the first TX of the history.
+    """
+    farm_client = SushiswapFarmsClient()
+    market_id = farm_client.getMarketForLPToken(pool)
+    if market_id == None:
+        return None, None
+
+    start_block = min(txs[0].blockNumber for txs in positions.values())
+    return market_id, farm_client.getTransactionsOfPositionsClosedSince(market_id, start_block - 1, head_block)
+
+def get_head_block():
+    """Return the latest block indexed by both Sushiswap subgraphs, incremental runs collect data as of this block."""
+    return min(PositionHandler(SUSHISWAP_ENDPOINT).getHeadBlock(), SushiswapFarmsClient().getHeadBlock())
+
+def watermark_path(filename):
+    return os.path.splitext(filename)[0] + ".watermark.json"
+
+def load_watermark(filename):
+    """Return watermark of stats in filename, dict with the last collected block and IDs of pending positions.
+    Return None if stats weren't collected incrementally yet.
+    """
+    path = watermark_path(filename)
+    if not os.path.isfile(filename) or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_watermark(filename, block, pending):
+    path = watermark_path(filename)
+    with open(path + ".tmp", "w") as f:
+        json.dump({"block": block, "pending": pending}, f)
+    os.replace(path + ".tmp", path)
+
+def prefetch_data_for(pool_addresses):
+    """Fetch raw positions and farm transactions of all pools concurrently.
+    Return dict of raw positions by pool and dict of (farm market ID, farm transactions) by pool.
+    """
+    position_handler = PositionHandler(SUSHISWAP_ENDPOINT)
+    raw_positions = position_handler.getRawClosedPositionsForMarkets(pool_addresses, SCAN_CONCURRENCY)
 
-    for p in protocols:
-        print("\nCollecting data for " + p + "...")
-        filename = "stats/top20-tvl-stats/" + p + ".csv"
-
-        # if data exists don't collect it again
-        if os.path.isfile(filename):
-            continue
-
-        collect_data_for(pools[p], filename)
-
-def collect_top_20_by_trading_volume():
-    protocols = [
-        'CRV_WETH',
-        'ALCX_WETH',
-        'RADAR_WETH',
-        'METIS_WETH',
-        'OHM_WETH',
-        'DAI_WETH',
-        'SUSHI_WETH',
-        'YGG_WETH',
-        'KP3R_WETH',
-        'YFI_WETH',
-        'UST_WETH',
-        'WBTC_WETH',
-        'SPELL_WETH',
-        'BOND_WETH',
-        'AAVE_WETH',
-        'REN_WETH',
-        'CREAM_WETH',
-        'COMP_WETH'
-    ]
+    farm_client = SushiswapFarmsClient()
+    farm_markets = {pool: farm_client.getMarketForLPToken(pool) for pool in pool_addresses}
+    farm_market_ids = [market_id for market_id in farm_markets.values() if market_id != None]
+    farm_transactions = farm_client.getTransactionsOfClosedPositionsForMarkets(farm_market_ids, SCAN_CONCURRENCY)
+
+    farm_data = {}
+    for pool, market_id in farm_markets.items():
+        farm_data[pool] = (market_id, farm_transactions.get(market_id))
+
+    return raw_positions, farm_data
+
+def collect_pools(protocols, folder, incremental=False, workers=1):
+    """Collect stats for every pool in protocols which doesn't have stats in folder yet.
+    In incremental mode, stats of every pool are updated with positions closed since the last run instead.
+    """
+    collect_pools_into_folders({folder: protocols}, workers, incremental)
+
+def collect_pool_lists(list_names, workers=WORKERS, incremental=False):
+    """Collect stats of pool lists from POOL_LISTS, pools which are in multiple lists are computed only once."""
+    collect_pools_into_folders(dict(POOL_LISTS[name] for name in list_names), workers, incremental)
+
+def collect_pools_into_folders(folders, workers=WORKERS, incremental=False):
+    """Collect stats for pools of every folder, given as dict of pool names by folder.
+    Every pool is computed once into SHARED_STATS_FOLDER, on workers processes, and then copied to all its folders.
+    Without incremental mode, pools which already have stats in a folder are skipped.
+    """
+
+    # folders which need stats of the pool
+    targets = {}
+    for folder, protocols in folders.items():
+        for p in protocols:
+            if incremental or not os.path.isfile(folder + p + ".csv"):
+                if p not in targets: targets[p] = []
+                if folder not in targets[p]: targets[p].append(folder)
+    if not targets:
+        return
+
+    os.makedirs(SHARED_STATS_FOLDER, exist_ok=True)
+    to_collect = [p for p in targets if incremental or not os.path.isfile(SHARED_STATS_FOLDER + p + ".csv")]
+    print("Pools to collect: {0}, already collected: {1}".format(len(to_collect), len(targets) - len(to_collect)))
+
+    # all the pools are collected as of the same block
+    head_block = get_head_block() if incremental else None
+
+    if workers <= 1:
+        collect_shared_stats(to_collect, head_block)
+    else:
+        context = multiprocessing.get_context("spawn")
+        # workers share the rate limit of the subgraphs
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                                    initializer=transport.share_rate_limit, initargs=(workers,)) as executor:
+            # fail on the first error, same as serial collection does
+            for _ in executor.map(collect_shared_stats, [[p] for p in to_collect], [head_block] * len(to_collect)):
+                pass
+
+    for p, pool_folders in targets.items():
+        for folder in pool_folders:
+            materialize_stats(p, folder)
+
+def collect_shared_stats(protocols, head_block=None):
+    """Collect stats of pools into SHARED_STATS_FOLDER, incrementally if head_block is given.
+    Subgraph data for all the pools is fetched concurrently upfront.
+    """
+
+    if head_block is not None:
+        for p in protocols:
+            print("\nCollecting new data for " + p + "...")
+            collect_new_data_for(pools[p], SHARED_STATS_FOLDER + p + ".csv", head_block)
+        return
+
+    # metrics of prefetching are exported with the first pool
+    with metrics.stage("prefetch"):
+        raw_positions, farm_data = prefetch_data_for(list(set(pools[p] for p in protocols)))
 
     for p in protocols:
         print("\nCollecting data for " + p + "...")
-        filename = "stats/top20-volume-stats/" + p + ".csv"
-
-        # if data exists don't collect it again
-        if os.path.isfile(filename):
-            continue
-
-        collect_data_for(pools[p], filename)
-
-def collect_defi_pools():
-    protocols = [
-        'CRV_WETH',
-        'SUSHI_WETH',
-        'YFI_WETH',
-        'AAVE_WETH',
-        'COMP_WETH',
-        'CVX_WETH',
-        'SNX_WETH',
-        'MKR_WETH',
-        'UNI_WETH'
-    ]
+        filename = SHARED_STATS_FOLDER + p + ".csv"
+        collect_data_for(pools[p], filename, raw_positions[pools[p]], farm_data[pools[p]])
 
-    for p in protocols:
-        print("\nCollecting data for " + p + "...")
-        filename = "stats/defi-pools-stats/" + p + ".csv"
+def materialize_stats(p, folder):
+    """Copy stats of pool from SHARED_STATS_FOLDER to folder, CSV file and pool's partition of the Parquet dataset."""
 
-        # if data exists don't collect it again
-        if os.path.isfile(filename):
-            continue
+    os.makedirs(folder, exist_ok=True)
+    shutil.copyfile(SHARED_STATS_FOLDER + p + ".csv", folder + p + ".csv")
 
-        collect_data_for(pools[p], filename) 
+    partition = "market=" + pools[p]
+    shared_partition = os.path.join(stats_dataset.dataset_folder(SHARED_STATS_FOLDER + p + ".csv"), partition)
+    if os.path.isdir(shared_partition):
+        folder_partition = os.path.join(stats_dataset.dataset_folder(folder + p + ".csv"), partition)
+        if os.path.isdir(folder_partition):
+            shutil.rmtree(folder_partition)
+        shutil.copytree(shared_partition, folder_partition)
 
-def collect_stablecoin_pools():
-    protocols = [
-        'USDC_WETH',
-        'USDT_WETH',
-        'DAI_WETH',
-    ]
+def collect_top_20_by_tvl(incremental=False):
+    collect_pools(*POOL_LISTS["top20-tvl"], incremental)
 
-    for p in protocols:
-        print("\nCollecting data for " + p + "...")
-        filename = "stats/stablecoin-pools-stats/" + p + ".csv"
+def collect_top_20_by_trading_volume(incremental=False):
+    collect_pools(*POOL_LISTS["top20-volume"], incremental)
 
-        # if data exists don't collect it again
-        if os.path.isfile(filename):
-            continue
+def collect_defi_pools(incremental=False):
+    collect_pools(*POOL_LISTS["defi"], incremental)
 
-        collect_data_for(pools[p], filename) 
+def collect_stablecoin_pools(incremental=False):
+    collect_pools(*POOL_LISTS["stablecoin"], incremental)
 
 
 def main():
-    # collect_data_for_dai_weth()
-    # collect_data_for_ldo_weth()
-    # collect_data_for_aave_weth()
-    # collect_data_for_usdc_weth()
-    # collect_data_for_wbtc_weth()
-    # collect_data_for_usdt_weth()
-    # collect_data_for_yfi_weth()
-    # collect_data_for_ilv_weth()
-
-    # collect_data_for_sushi_weth()
-    # collect_data_for_toke_weth()
-    # collect_data_for_bit_weth()
-    # collect_data_for_alcx_weth()
-    # collect_data_for_ygg_weth()
-    # collect_data_for_jpeg_weth()
-    # collect_data_for_srm_weth()
-    # collect_data_for_comp_weth()
-    # collect_data_for_punk_weth()
-
-    # collect_top_20_by_tvl()
-    collect_top_20_by_trading_volume()
-    collect_defi_pools()
-    collect_stablecoin_pools()
-
-    # collect_data_for_alls()
+    parser = argparse.ArgumentParser(description="Collect profitability stats of Sushiswap LP positions.")
+    parser.add_argument("lists", nargs="*", default=["top20-volume", "defi", "stablecoin"],
+                        help="pool lists to collect, any of: {0} (default: top20-volume defi stablecoin)".format(", ".join(POOL_LISTS)))
+    parser.add_argument("--workers", type=int, default=WORKERS, help="number of pools collected in parallel")
+    parser.add_argument("--incremental", action="store_true", help="update existing stats with positions closed since the last run")
+    parser.add_argument("--all-positions", action="store_true", help="collect stats of all positions in ETH markets instead of pool lists")
+    parser.add_argument("--stream", action="store_true", help="with --all-positions, process positions in batches with bounded memory")
+    parser.add_argument("--batch-size", type=int, default=STREAM_BATCH_SIZE, help="number of merged positions priced together with --stream")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.lists if name not in POOL_LISTS]
+    if unknown:
+        parser.error("unknown pool lists: {0}".format(", ".join(unknown)))
+
+    if args.all_positions and args.stream:
+        stream_data_for_alls(batch_size=args.batch_size)
+        return
+    if args.all_positions:
+        collect_data_for_alls()
+        return
+
+    collect_pool_lists(args.lists, args.workers, args.incremental)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,32 +1,17 @@
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
-
 from price_helper import PriceProvider
+from subgraph_client import GraphClient
+from pagination import Paginator, DEFAULT_CONCURRENCY, DEFAULT_SHARDS, complete_groups
+from position_model import Transaction, TxType, address_table
+import os
 
 WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
-
-price_provider = PriceProvider()
-
-class GraphClient:
-
-    def __init__(self, endpoint):
-        self._subgraph_endpoint = endpoint
-        transport = AIOHTTPTransport(url=endpoint)
-        self._client = Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=120)
-    
-    def _load_query(self, filename):
-        with open(filename) as f:
-            return gql(f.read())
-
-    def runQuery(self, filename, args):
-        query = self._load_query(filename)
-        response = self._client.execute(query, variable_values=args)
-        return response
+SUSHISWAP_FARMS_ENDPOINT = os.environ.get("SUSHISWAP_FARMS_ENDPOINT", "https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap-farms")
 
 class SushiswapFarmsClient(GraphClient):
     
     def __init__(self):
-      super().__init__("https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap-farms")
+      super().__init__(SUSHISWAP_FARMS_ENDPOINT)
+      self._price_provider = PriceProvider()
 
     def getMarketForLPToken(self, lpToken):
       response = self.runQuery("queries/get_farm_for_lp_token.graphql", {"lpToken": lpToken})
@@ -38,183 +23,238 @@ class SushiswapFarmsClient(GraphClient):
         """Fetch closed positions from the Sushiswap subgraph.
         Return a dictionary where key is account address of position and value is list of TXs.
         """
-        
-        raw_positions = {}
-        lastID = ""
 
-        while True:
-            vars = {"lastID": lastID, "market": marketId}
-            query = self._load_query('queries/get_raw_closed_positions.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['positions']:
-                break
+        return self.getTransactionsOfClosedPositionsForMarkets([marketId])[marketId]
 
-            for position in response['positions']:
-                if not position['accountAddress'] in raw_positions: raw_positions[position['accountAddress']] = []
-                for positionSnapshot in position['history']:
-                    tx = positionSnapshot['transaction']
-                    tx["blockNumber"] = int(tx["blockNumber"])
-                    raw_positions[position['accountAddress']].append(tx)
-            
-            lastID = response['positions'][-1]['id']
-            print("Processed farm positions:", len(raw_positions))
-        
-        return raw_positions
-    
-    def getFarmTransactionsForPositions(self, farm_address, farm_transactions, pool_transactions):
-        farm_transactions_for_positions = {}
+    def getTransactionsOfClosedPositionsForMarkets(self, marketIds, concurrency=DEFAULT_CONCURRENCY):
+        """Fetch closed positions of multiple farms, scanning all farms concurrently.
+        Return a dictionary where key is farm market ID and value is dict as returned by getTransactionsOfClosedPositions.
+        """
 
-        transaction_ids = []  # Required to avoid duplicate transactions 
-        for position_id in pool_transactions.keys():
-            account_address = pool_transactions[position_id][0]["accountAddress"]
-            if not account_address in farm_transactions: continue
-            farm_transactions_for_account = farm_transactions[account_address]
+        vars_list = [{"market": marketId} for marketId in marketIds]
+        scans = Paginator(self, concurrency).scan('queries/get_raw_closed_positions.graphql', 'positions', vars_list, "farm positions")
 
-            for tx in pool_transactions[position_id]:
-                if (tx["transactionType"] == "TRANSFER_OUT" and tx["transferredTo"] == farm_address) or (tx["transactionType"] == "TRANSFER_IN" and tx["transferredFrom"] == farm_address):
-                    transactions = list(filter(lambda x: x["transactionHash"] == tx["transactionHash"], farm_transactions_for_account))
-                    if transactions:
-                        if not position_id in farm_transactions_for_positions: farm_transactions_for_positions[position_id] = []
-                        for transaction in transactions:
-                            if not transaction["id"] in transaction_ids:
-                                farm_transactions_for_positions[position_id].append(transaction)
-                                transaction_ids.append(transaction["id"])
+        raw_positions_by_market = {}
+        for marketId, rows in zip(marketIds, scans):
+            raw_positions_by_market[marketId] = self._parseFarmPositions(rows)
+
+        return raw_positions_by_market
+
+    def getTransactionsOfPositionsClosedSince(self, marketId, block, head_block):
+        """Fetch positions of farm closed after block, as of head_block.
+        Return a dictionary where key is account address of position and value is list of TXs.
+        """
+
+        vars = {"market": marketId, "closedAfter": block, "block": head_block}
+        [rows] = Paginator(self).scan('queries/get_raw_positions_closed_since.graphql', 'positions', [vars], "farm positions")
+        return self._parseFarmPositions(rows)
+
+    def _parseFarmPositions(self, positions, with_market=False):
+        """Return dict where key is account address and value list of TXs of its positions.
+        If with_market is set, TXs get farm market ID from position ID, for positions of all farms.
+        """
+
+        raw_positions = {}
+        for position in positions:
+            if not position['accountAddress'] in raw_positions: raw_positions[position['accountAddress']] = []
+            market_id = "-".join(position["id"].split("-")[1:3]) if with_market else None
+            for positionSnapshot in position['history']:
+                tx = Transaction.fromSubgraph(positionSnapshot['transaction'], position['accountAddress'], market_id)
+                raw_positions[position['accountAddress']].append(tx)
+        return raw_positions
+
+    def getFarmTransactionsForPositions(self, farm_address, farm_transactions, pool_transactions):
+        farm_index = self._indexFarmTransactions(farm_transactions)
+        farm = (address_table.intern(farm_address), None)
+        return self._joinFarmTransactions(pool_transactions, farm_index, lambda position_id: farm)
 
-        return farm_transactions_for_positions
-    
     # Fuctions for processing all farms together
     def getAllMarkets(self,):
         """Fetch all markets from the Sushiswap subgraph.
         Return a dictionary where key is input token and value market id.
         """
-        
-        markets = {}
-        lastID = ""
 
-        while True:
-            vars = {"lastID": lastID}
-            query = self._load_query('queries/get_all_markets.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['markets']:
-                break
+        [rows] = Paginator(self).scan('queries/get_all_markets.graphql', 'markets', [{}], "farm markets")
+
+        markets = {}
+        for market in rows:
+            for input_token in market["inputTokens"]:
+              markets[input_token["id"]] = market["id"]
 
-            for market in response['markets']:
-                for input_token in market["inputTokens"]:
-                  markets[input_token["id"]] = market["id"]
-            
-            lastID = response['markets'][-1]['id']
-            print("Processed farm markets:", len(response["markets"]))
-        
         return markets
 
     # Two methods below assume that there is only one farm for every LP token
-    def getTransactionsOfAllClosedPositions(self):
+    def getTransactionsOfAllClosedPositions(self, shards=DEFAULT_SHARDS):
         """Fetch closed positions from the Sushiswap subgraph.
+        Position ID space is split into shards which are scanned in parallel.
         Return a dictionary where key is account address of position and value is list of TXs.
         """
-        
-        raw_positions = {}
-        lastID = ""
 
-        while True:
-            vars = {"lastID": lastID}
-            query = self._load_query('queries/get_all_raw_closed_positions.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['positions']:
-                break
+        rows = Paginator(self, shards).shardedScan('queries/get_all_raw_closed_positions.graphql', 'positions', {}, shards, "farm positions")
+        return self._parseFarmPositions(rows, with_market=True)
 
-            for position in response['positions']:
-                if not position['accountAddress'] in raw_positions: raw_positions[position['accountAddress']] = []
-                for positionSnapshot in position['history']:
-                    tx = positionSnapshot['transaction']
-                    tx["blockNumber"] = int(tx["blockNumber"])
-                    tx["marketId"] = "-".join(position["id"].split("-")[1:3])
-                    raw_positions[position['accountAddress']].append(tx)
-            
-            lastID = response['positions'][-1]['id']
-            print("Processed farm positions:", len(raw_positions))
-        
-        return raw_positions
+    def iterTransactionsOfAllClosedPositions(self, shards=DEFAULT_SHARDS):
+        """Streaming version of getTransactionsOfAllClosedPositions: yield dicts of TXs by account, ordered by account.
+        All TXs of an account come in the same dict.
+        """
 
-    def getFarmTransactionsForAllPositions(self, farms, farm_transactions, pool_transactions):
-        farm_transactions_for_positions = {}
+        pages = Paginator(self, shards).iterShardedScan('queries/get_all_raw_closed_positions.graphql', 'positions', {}, shards, "farm positions")
+        for rows in complete_groups(pages, lambda row: row['accountAddress']):
+            yield self._parseFarmPositions(rows, with_market=True)
 
-        transaction_ids = []  # Required to avoid duplicate transactions 
-        for position_id in pool_transactions.keys():
-            account_address = pool_transactions[position_id][0]["accountAddress"]
-            if not account_address in farm_transactions: continue
-            
-            pool_address = position_id.split("-")[1]
-            if not pool_address in farms: continue
+    def getFarmTransactionsForAllPositions(self, farms, farm_transactions, pool_transactions):
+        farm_index = self._indexFarmTransactions(farm_transactions)
 
+        def farm_for_position(position_id):
             # Filter by input token for the farm which is a LP token of an exchange pool
-            farm_id = farms[pool_address]
-            farm_address = farm_id.split("-")[0]
-            farm_transactions_for_account = list(filter(lambda x: x["marketId"] == farm_id, farm_transactions[account_address]))
+            farm_id = farms.get(position_id.split("-")[1])
+            if farm_id is None:
+                return None
+            return address_table.intern(farm_id.split("-")[0]), farm_id
+
+        return self._joinFarmTransactions(pool_transactions, farm_index, farm_for_position)
 
-            if not farm_transactions_for_account: continue
+    def _indexFarmTransactions(self, farm_transactions):
+        """Index farm TXs by (account, farm market ID, transaction hash).
+        Farm market ID is None for TXs fetched for a single farm, which don't have marketId.
+        """
+
+        farm_index = {}
+        for transactions in farm_transactions.values():
+            for tx in transactions:
+                key = (tx.accountAddress, tx.marketId, tx.transactionHash)
+                if key not in farm_index: farm_index[key] = []
+                farm_index[key].append(tx)
+        return farm_index
+
+    def _joinFarmTransactions(self, pool_transactions, farm_index, farm_for_position):
+        """Match pool TXs moving LP tokens to/from the farm with farm TXs from the same transaction.
+        farm_for_position returns (farm address ID, farm market ID) for a position ID, or None if pool has no farm.
+        Single pass over pool TXs, every lookup is a hash lookup.
+        """
+
+        farm_transactions_for_positions = {}
+
+        transaction_ids = set()  # Required to avoid duplicate transactions
+        for position_id, txs in pool_transactions.items():
+            farm = farm_for_position(position_id)
+            if farm is None: continue
+            farm_address, farm_id = farm
+            account_address = txs[0].accountAddress
 
-            for tx in pool_transactions[position_id]:
-                if (tx["transactionType"] == "TRANSFER_OUT" and tx["transferredTo"] == farm_address) or (tx["transactionType"] == "TRANSFER_IN" and tx["transferredFrom"] == farm_address):
-                    transactions = list(filter(lambda x: x["transactionHash"] == tx["transactionHash"], farm_transactions_for_account))
+            for tx in txs:
+                if (tx.transactionType == TxType.TRANSFER_OUT and tx.transferredTo == farm_address) or (tx.transactionType == TxType.TRANSFER_IN and tx.transferredFrom == farm_address):
+                    transactions = farm_index.get((account_address, farm_id, tx.transactionHash))
                     if transactions:
                         if not position_id in farm_transactions_for_positions: farm_transactions_for_positions[position_id] = []
                         for transaction in transactions:
-                            if not transaction["id"] in transaction_ids:
+                            if not transaction.id in transaction_ids:
                                 farm_transactions_for_positions[position_id].append(transaction)
-                                transaction_ids.append(transaction["id"])
+                                transaction_ids.add(transaction.id)
 
         return farm_transactions_for_positions
-    
+
     def addRewardValueInUSD(self, farm_transactions):
+        """Set rewardValuesInUSD of farm TXs which claimed rewards and drop the other TXs.
+        Return dict where key is position ID and value list of TXs with rewards.
+        """
+
+        # load decimals of all reward tokens at once
+        self._price_provider.prefetchTokens(
+            address_table.address(token) for transactions in farm_transactions.values() for tx in transactions for token in tx.rewardTokens)
+
         blocks = []
         rewardTokens = []
         transactions_with_prices = {}
         for position_id in farm_transactions.keys():
             transactions = []
             for tx in farm_transactions[position_id]:
-                rewards = list(map(lambda x: self.parseTokenBalance(x), tx["rewardTokenAmounts"]))
-                nonZero = list(filter(lambda x: x["amount"] > 0, rewards))
+                rewards = self.rewardAmounts(tx)
+                nonZero = [(token, amount) for (token, amount) in rewards if amount > 0]
                 if nonZero:
-                    tx["rewardTokenAmounts"] = rewards
                     transactions.append(tx)
-                    blocks.append(tx["blockNumber"])
-                    for reward in nonZero:
-                        if not reward["token"] in rewardTokens: rewardTokens.append(reward["token"])
+                    blocks.append(tx.blockNumber)
+                    for token, amount in nonZero:
+                        if not token in rewardTokens: rewardTokens.append(token)
             transactions_with_prices[position_id] = transactions
         
         # Fetch prices only once for all the blocks we need
         prices = {}
-        prices[WETH] = price_provider.getEthPriceinUSDForBlocks(blocks)
+        prices[WETH] = self._price_provider.getEthPriceinUSDForBlocks(blocks)
         for token in rewardTokens:
-            prices[token] = price_provider.getTokenPriceinUSDForBlocks(token, blocks, prices[WETH])
+            prices[token] = self._price_provider.getTokenPriceinUSDForBlocks(token, blocks, prices[WETH])
         
-        for position_id in transactions_with_prices.keys():
-            transactions = []
-            for tx in transactions_with_prices[position_id]:
-                rewards = []
-                for reward in tx["rewardTokenAmounts"]:
-                    token = reward["token"]
-                    block = tx["blockNumber"]
-                    reward["price"] = prices[token][block]
-                    reward["valueInUSD"] = reward["amount"] * reward["price"]
-                    rewards.append(reward)
-                tx["rewardTokenAmounts"] = rewards
-                transactions.append(tx)
-            transactions_with_prices[position_id] = transactions
+        for transactions in transactions_with_prices.values():
+            for tx in transactions:
+                values = []
+                for token, amount in self.rewardAmounts(tx):
+                    price = prices[token][tx.blockNumber] if amount > 0 and prices[token] else None
+                    # price is unknown before the first snapshot of token's market
+                    values.append(amount * price if price is not None else 0)
+                tx.rewardValuesInUSD = tuple(values)
         return transactions_with_prices
 
-    def parseTokenBalance(self, tokenBalance):
-        parts = tokenBalance.split("|")
-        token = parts[0]
-        decimals = price_provider.decimals(token)
-        if decimals == None:
-            return {
-                "token": token,
-                "amount": 0
-            }
-        amount = int(parts[2]) * pow(10, (-1) * decimals)
-        return {
-          "token": token,
-          "amount": amount
-        }
\ No newline at end of file
+    def rewardAmounts(self, tx):
+        """Return list of (reward token, amount) of farm TX, amounts adjusted by token decimals.
+        Amount is 0 if token decimals are unknown.
+        """
+
+        rewards = []
+        for token_id, raw_amount in zip(tx.rewardTokens, tx.rewardAmounts):
+            token = address_table.address(token_id)
+            decimals = self._price_provider.decimals(token)
+            amount = raw_amount * pow(10, (-1) * decimals) if decimals != None else 0
+            rewards.append((token, amount))
+        return rewards
+
+
+class FarmTransactionStream:
+    """Farm TXs of all farms read along with batches of pool positions, both ordered by account.
+    Only TXs of accounts which the batches haven't passed yet are held in memory.
+    """
+
+    def __init__(self, farm_client, farms, farm_transactions):
+        """farms - dict as returned by getAllMarkets
+        farm_transactions - iterator of dicts as yielded by iterTransactionsOfAllClosedPositions
+        """
+        self._farm_client = farm_client
+        self._farms = farms
+        self._farm_transactions = farm_transactions
+        self._window = {}
+        self._last_account = None
+        self._exhausted = False
+
+    def getFarmTransactions(self, positions):
+        """Return farm TXs with reward values of batch of merged positions, as returned by addRewardValueInUSD.
+        Batches have to come in account order, every batch after the previous one.
+        """
+
+        if not positions:
+            return {}
+        accounts = [position_id.split("-")[0] for position_id in positions]
+        first_account, last_account = min(accounts), max(accounts)
+
+        # TXs of accounts before the batch can't match any more positions
+        for account in [account for account in self._window if account < first_account]:
+            del self._window[account]
+
+        # read farm TXs until all TXs of the batch's accounts are in
+        while not self._exhausted and (self._last_account is None or self._last_account < last_account):
+            transactions = next(self._farm_transactions, None)
+            if transactions is None:
+                self._exhausted = True
+                break
+            self._window.update(transactions)
+            self._last_account = max(transactions)
+
+        farm_transactions = self._farm_client.getFarmTransactionsForAllPositions(self._farms, self._window, positions)
+
+        # farm TX is matched to one position only, as if all positions were joined at once
+        matched = {}
+        for transactions in farm_transactions.values():
+            for tx in transactions:
+                matched.setdefault(address_table.address(tx.accountAddress), set()).add(tx.id)
+        for account, ids in matched.items():
+            self._window[account] = [tx for tx in self._window[account] if tx.id not in ids]
+
+        return self._farm_client.addRewardValueInUSD(farm_transactions)
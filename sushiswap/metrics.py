@@ -0,0 +1,188 @@
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of metric names in Prometheus export
+PROMETHEUS_PREFIX = "sushiswap_"
+
+# Upper bounds of histogram buckets, in seconds for latencies and stages and in rows for pages
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200)
+ROWS_BUCKETS = (0, 10, 50, 100, 250, 500, 1000)
+
+# Stage of queries made outside of any stage
+NO_STAGE = "none"
+
+# Counters
+REQUESTS = "requests"
+RETRIES = "retries"
+ERRORS = "errors"
+BYTES = "bytes_received"
+CACHE_HITS = "cache_hits"
+CACHE_MISSES = "cache_misses"
+POSITIONS = "positions"
+# Histograms
+LATENCY = "request_latency_seconds"
+PAGE_ROWS = "page_rows"
+STAGE_SECONDS = "stage_seconds"
+
+# Buckets of histograms by name, latency buckets for the others
+HISTOGRAM_BUCKETS = {PAGE_ROWS: ROWS_BUCKETS, STAGE_SECONDS: STAGE_BUCKETS}
+
+
+class Histogram:
+    """Counts of observed values by bucket upper bound, the last bucket has no bound."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None or value > self.max else self.max
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q, at most the max observed value."""
+
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5) if self.count else None,
+            "p95": self.quantile(0.95) if self.count else None,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """Counters and histograms of a run, labeled by pipeline stage and query file.
+    Stage is set for the whole process by stage(), as stages of a run don't overlap. Queries are recorded
+    from any thread, including the connection pool's event loop.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stage = NO_STAGE
+            self._counters = {}
+            self._histograms = {}
+            self._started = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """Label everything recorded within the block with stage name and record the stage's duration."""
+
+        previous, self._stage = self._stage, name
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(STAGE_SECONDS, time.monotonic() - start_time)
+            self._stage = previous
+
+    def increment(self, name, amount=1, query=None):
+        key = (name, self._stage, query)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, query=None):
+        key = (name, self._stage, query)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(HISTOGRAM_BUCKETS.get(name, LATENCY_BUCKETS))
+            histogram.observe(value)
+
+    def summary(self):
+        """Return dict of metrics by stage, with totals of the stage and metrics of every query file within it."""
+
+        with self._lock:
+            stages = {}
+
+            def entry(stage, query):
+                stage_entry = stages.setdefault(stage, {"queries": {}})
+                return stage_entry if query is None else stage_entry["queries"].setdefault(query, {})
+
+            for (name, stage, query), value in self._counters.items():
+                entry(stage, query)[name] = value
+            for (name, stage, query), histogram in self._histograms.items():
+                entry(stage, query)[name] = histogram.summary()
+
+            for stage_entry in stages.values():
+                seconds = stage_entry.get(STAGE_SECONDS, {}).get("sum")
+                if POSITIONS in stage_entry and seconds:
+                    stage_entry["positions_per_second"] = stage_entry[POSITIONS] / seconds
+
+            return {"started": self._started, "seconds": time.time() - self._started, "stages": stages}
+
+    def prometheus(self):
+        """Return metrics in Prometheus text exposition format."""
+
+        def labels(stage, query, **extra):
+            pairs = [("stage", stage)] + ([("query", query)] if query is not None else []) + list(extra.items())
+            return "{" + ",".join('{0}="{1}"'.format(key, value) for key, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for name in sorted(set(key[0] for key in self._counters)):
+                metric = PROMETHEUS_PREFIX + name + "_total"
+                lines.append("# TYPE {0} counter".format(metric))
+                for (counter_name, stage, query), value in sorted(self._counters.items(), key=_sort_key):
+                    if counter_name == name:
+                        lines.append("{0}{1} {2}".format(metric, labels(stage, query), value))
+
+            for name in sorted(set(key[0] for key in self._histograms)):
+                metric = PROMETHEUS_PREFIX + name
+                lines.append("# TYPE {0} histogram".format(metric))
+                for (histogram_name, stage, query), histogram in sorted(self._histograms.items(), key=_sort_key):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append("{0}_bucket{1} {2}".format(metric, labels(stage, query, le=bound), cumulative))
+                    lines.append("{0}_sum{1} {2}".format(metric, labels(stage, query), histogram.sum))
+                    lines.append("{0}_count{1} {2}".format(metric, labels(stage, query), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def export(self, filename):
+        """Write JSON summary and Prometheus text file of the run next to stats file filename."""
+
+        basename = os.path.splitext(filename)[0]
+        _write(basename + ".metrics.json", json.dumps(self.summary(), indent=2))
+        _write(basename + ".prom", self.prometheus())
+
+
+def _sort_key(item):
+    name, stage, query = item[0]
+    return name, stage, query or ""
+
+
+def _write(path, text):
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+metrics = Metrics()
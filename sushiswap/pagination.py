@@ -0,0 +1,221 @@
+import asyncio
+import os
+
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+from metrics import metrics, PAGE_ROWS
+from transport import ResponseSize
+
+# Max number of page requests in flight at the same time
+DEFAULT_CONCURRENCY = 8
+
+# Number of ID ranges the entity scans over all positions are split into
+DEFAULT_SHARDS = 16
+
+# Upper bound greater than any hex ID ('y' > 'x' in '0x...')
+MAX_ID = "0y"
+
+# Page size of the scans, passed as $first. Default is what the queries use when $first isn't set.
+PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 50
+# Bytes received for a page the page size is adapted to, pages with long histories get fewer rows
+TARGET_PAGE_BYTES = 2 * 1024 * 1024
+# Errors of pages too heavy for the indexer even after retries, page is retried at half the size
+PAGE_ERRORS = (TransportQueryError, TransportServerError, asyncio.TimeoutError)
+
+# Pages a shard of a streaming scan fetches ahead of the consumer
+PREFETCH_PAGES = 1
+
+def id_shards(count):
+    """Split the space of hex IDs (ie. '0x1f...-0x33...-INVESTMENT-1') into count ranges by ID prefix.
+    Return list of (lower, upper) bounds to be used as id_gt and id_lt, ordered by ID.
+    """
+
+    resolution = 16 ** 3
+    prefixes = ["0x" + format(i * resolution // count, "03x") for i in range(1, count)]
+
+    lower_bounds = [""] + prefixes
+    upper_bounds = prefixes + [MAX_ID]
+    return list(zip(lower_bounds, upper_bounds))
+
+def complete_groups(pages, key):
+    """Regroup pages of rows ordered by ID into lists of rows, so that rows with the same key(row) are never split
+    between two lists. Key has to be a prefix of the ID, ie. account of a position, so such rows are next to each other.
+    """
+
+    pending = []
+    for page in pages:
+        rows = pending + page
+        # rows of the last key may continue on the next page
+        last_key = key(rows[-1])
+        split = len(rows)
+        while split > 0 and key(rows[split - 1]) == last_key:
+            split -= 1
+        pending = rows[split:]
+        if split > 0:
+            yield rows[:split]
+
+    if pending:
+        yield pending
+
+class PageSizer:
+    """Page size of a scan, adapted to the size of the responses.
+    Every page moves the size towards the number of rows which fit into TARGET_PAGE_BYTES.
+    """
+
+    def __init__(self, size=PAGE_SIZE):
+        self.size = size
+
+    def vars(self, vars):
+        """Add page size to query variables. Default page size isn't set, so cache keys stay the same."""
+        return vars if self.size == PAGE_SIZE else dict(vars, first=self.size)
+
+    def onPage(self, rows, size):
+        """Adapt page size to a page of rows received in size bytes, None if the size isn't known."""
+
+        if rows == 0 or not size:
+            return
+        target = int(TARGET_PAGE_BYTES * rows / size)
+        # grow gradually, shrink right away
+        self.size = max(MIN_PAGE_SIZE, min(PAGE_SIZE, target, self.size * 2))
+
+    def onError(self):
+        """Halve page size after a failed page. Return False if it's already the smallest one."""
+
+        if self.size <= MIN_PAGE_SIZE:
+            return False
+        self.size = max(MIN_PAGE_SIZE, self.size // 2)
+        return True
+
+
+class Paginator:
+    """Async pagination engine for the queries with `id_gt: $lastID` cursor.
+    Pages of a single scan are fetched one after another because every page depends on the last ID
+    of the previous one, but any number of scans (ie. one per market) run concurrently.
+    """
+
+    def __init__(self, graph_client, concurrency=DEFAULT_CONCURRENCY):
+        self._graph_client = graph_client
+        self._concurrency = concurrency
+
+    def scan(self, filename, entity, vars_list, label=None):
+        """Run a scan for every set of variables in vars_list.
+        Return list of rows for every scan, in the same order as vars_list.
+        """
+        return self._graph_client.runAsync(self._scanAll(filename, entity, vars_list, label))
+
+    def shardedScan(self, filename, entity, vars, shards=DEFAULT_SHARDS, label=None):
+        """Split a single scan into ID ranges and walk them concurrently.
+        Query has to take $upperID variable used as `id_lt` bound.
+        Return list of rows ordered by ID, same as a single scan would.
+        """
+
+        vars_list = [dict(vars, lastID=lower, upperID=upper) for lower, upper in id_shards(shards)]
+        rows = []
+        for shard_rows in self.scan(filename, entity, vars_list, label):
+            rows.extend(shard_rows)
+        return rows
+
+    def iterShardedScan(self, filename, entity, vars, shards=DEFAULT_SHARDS, label=None):
+        """Streaming version of shardedScan: yield pages of rows ordered by ID.
+        The shard being consumed and the ones after it are scanned concurrently, as many as the concurrency
+        of the paginator. Every shard is at most PREFETCH_PAGES pages ahead of the consumer, so the rows held
+        in memory depend on the concurrency rather than the size of the scan.
+        """
+
+        vars_list = [dict(vars, lastID=lower, upperID=upper) for lower, upper in id_shards(shards)]
+        semaphore = self._graph_client.runAsync(_semaphore(self._concurrency))
+        streams = []
+        try:
+            count = 0
+            for i in range(len(vars_list)):
+                # next shards are scanned while this one is consumed
+                while len(streams) < min(i + self._concurrency, len(vars_list)):
+                    streams.append(self._graph_client.runAsync(self._startStream(semaphore, filename, entity, vars_list[len(streams)])))
+
+                queue, _ = streams[i]
+                while True:
+                    page = self._graph_client.runAsync(queue.get())
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    count += len(page)
+                    yield page
+
+            if label is not None:
+                print("Processed {0}: {1}".format(label, count))
+        finally:
+            # consumer may stop early, scans still waiting to put their pages are dropped
+            self._graph_client.runAsync(_cancel([task for _, task in streams]))
+
+    async def _startStream(self, semaphore, filename, entity, vars):
+        """Start scan putting its pages into a queue on the event loop. Return (queue, task)."""
+
+        queue = asyncio.Queue(PREFETCH_PAGES)
+        return queue, asyncio.ensure_future(self._stream(semaphore, filename, entity, vars, queue))
+
+    async def _stream(self, semaphore, filename, entity, vars, queue):
+        """Put pages of a scan into queue, followed by None. Error of the scan is put in place of the next page."""
+
+        try:
+            async for page in self._pages(semaphore, filename, entity, vars):
+                await queue.put(page)
+        except Exception as error:
+            await queue.put(error)
+            return
+        await queue.put(None)
+
+    async def _scanAll(self, filename, entity, vars_list, label):
+        semaphore = asyncio.Semaphore(self._concurrency)
+        scans = [self._scan(semaphore, filename, entity, vars, label) for vars in vars_list]
+        return await asyncio.gather(*scans)
+
+    async def _scan(self, semaphore, filename, entity, vars, label):
+        rows = []
+        async for page in self._pages(semaphore, filename, entity, vars):
+            rows.extend(page)
+
+        if label is not None:
+            print("Processed {0}: {1}".format(label, len(rows)))
+        return rows
+
+    async def _pages(self, semaphore, filename, entity, vars):
+        """Yield non-empty pages of a scan, one after another."""
+
+        page_sizer = PageSizer()
+        lastID = vars.get("lastID", "")
+
+        while True:
+            cursor_vars = dict(vars, lastID=lastID)
+            # page cached in an earlier run is requested with the size it was cached with, whatever the sizer says
+            cached_size = self._graph_client.cachedPageSize(filename, cursor_vars)
+            if cached_size is not None:
+                page_sizer.size = cached_size
+            size = ResponseSize()
+            try:
+                async with semaphore:
+                    response = await self._graph_client.runQueryAsync(filename, page_sizer.vars(cursor_vars), size)
+            except PAGE_ERRORS:
+                if not page_sizer.onError():
+                    raise
+                continue
+
+            if cached_size != page_sizer.size:
+                self._graph_client.cachePageSize(filename, cursor_vars, page_sizer.size)
+            page_sizer.onPage(len(response[entity]), size.bytes)
+            metrics.observe(PAGE_ROWS, len(response[entity]), query=os.path.basename(filename))
+            if not response[entity]:
+                return
+
+            yield response[entity]
+            lastID = response[entity][-1]['id']
+
+async def _semaphore(value):
+    # created on the event loop it's used on
+    return asyncio.Semaphore(value)
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,143 @@
+import glob
+import hashlib
+import inspect
+import json
+import os
+import pickle
+
+from metrics import metrics
+
+ARTIFACTS_DIR = "cache/artifacts/"
+
+
+class Stage:
+    """Named step of a pipeline.
+    function is called with outputs of the input stages, in the order of inputs.
+    code - functions (or classes) whose source is part of the stage key, besides function itself
+    config - dict of values the stage depends on, ie. {"MASTERCHEFS": MASTERCHEFS}, for volatile stages their fetch parameters
+    volatile - stage reads external data (ie. the subgraph), so it runs every time and stages after it
+    are keyed by its code, config and the head block of the subgraph
+    """
+
+    def __init__(self, name, function, inputs=(), code=(), config=None, volatile=False):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.code = [function] + list(code)
+        self.config = config or {}
+        self.volatile = volatile
+
+
+class Pipeline:
+    """Stages with memoized outputs.
+    Output of every non volatile stage is stored under a key made of the stage's code, config and keys of its inputs,
+    so a re-run loads the stored outputs and computes only the stages from the first invalidated one on.
+    head_block - function returning the latest block of the subgraph, called once per run. Without it outputs
+    of volatile stages are keyed by their hash.
+    """
+
+    def __init__(self, name, stages, directory=ARTIFACTS_DIR, head_block=None):
+        self._name = name
+        self._head_block = head_block
+        self._stages = {}
+        for stage in stages:
+            for input_name in stage.inputs:
+                if input_name not in self._stages:
+                    raise ValueError("Input {0} of stage {1} is not defined before it".format(input_name, stage.name))
+            self._stages[stage.name] = stage
+        self._directory = os.path.join(directory, _slug(name))
+
+    def run(self, target, outputs=None):
+        """Return output of target stage, running only the stages it needs.
+        outputs - dict of outputs which are already known by stage name (ie. prefetched data), used instead of running the stage
+        """
+
+        self._outputs = dict(outputs or {})
+        self._keys = {}
+        self._run_head_block = None
+        try:
+            return self._output(target)
+        finally:
+            self._outputs = None
+            self._keys = None
+
+    def _key(self, name):
+        """Key of stage output: hash of what the output depends on. Volatile and given outputs depend on the head block
+        instead of inputs, or are keyed by the hash of the output if the pipeline has no head block.
+        """
+
+        if name in self._keys:
+            return self._keys[name]
+
+        stage = self._stages[name]
+        volatile = stage.volatile or name in self._outputs
+        if volatile and self._head_block is None:
+            key = hashlib.sha256(pickle.dumps(self._output(name))).hexdigest()
+        else:
+            payload = {
+                "stage": name,
+                "code": [_source(function) for function in stage.code],
+                "config": stage.config,
+            }
+            if volatile:
+                payload["head_block"] = self._headBlock()
+            else:
+                payload["inputs"] = [self._key(input_name) for input_name in stage.inputs]
+            key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=repr).encode()).hexdigest()
+
+        self._keys[name] = key
+        return key
+
+    def _headBlock(self):
+        if self._run_head_block is None:
+            self._run_head_block = self._head_block()
+        return self._run_head_block
+
+    def _output(self, name):
+        if name in self._outputs:
+            return self._outputs[name]
+
+        stage = self._stages[name]
+        if stage.volatile:
+            output = self._compute(stage)
+        else:
+            path = os.path.join(self._directory, name, self._key(name) + ".pickle")
+            if os.path.isfile(path):
+                print("Stage {0}: loaded".format(name))
+                with open(path, "rb") as f:
+                    output = pickle.load(f)
+            else:
+                output = self._compute(stage)
+                self._store(path, output)
+
+        self._outputs[name] = output
+        return output
+
+    def _compute(self, stage):
+        inputs = [self._output(input_name) for input_name in stage.inputs]
+        print("Stage {0}: running".format(stage.name))
+        with metrics.stage(stage.name):
+            return stage.function(*inputs)
+
+    def _store(self, path, output):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        # only the latest output of every stage is kept
+        for old_path in glob.glob(os.path.join(os.path.dirname(path), "*.pickle")):
+            if old_path != path:
+                os.remove(old_path)
+
+
+def _source(function):
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        return getattr(function, "__qualname__", repr(function))
+
+
+def _slug(name):
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
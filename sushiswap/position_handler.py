@@ -1,39 +1,62 @@
 import csv
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+import concurrent.futures
 from price_helper import PriceProvider
+from token_store import token_store
+from position_model import Transaction, TxType, address_table
+import stats_dataset
+from subgraph_client import GraphClient
+from pagination import Paginator, DEFAULT_CONCURRENCY, DEFAULT_SHARDS, complete_groups
 from datetime import datetime
-import time
+import os
+from metrics import metrics, POSITIONS
 
 WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
 MASTERCHEFS = ["0xc2edad668740f1aa35e4d8f227fb8e17dca888cd", "0xef0881ec094552b2e128cf945ef17a6752b4ec5d"]
+MASTERCHEF_IDS = set(address_table.intern(address) for address in MASTERCHEFS)
 
-class PositionHandler:
+# Max number of tokens whose prices are fetched at the same time
+PRICE_CONCURRENCY = 8
 
-    def __init__(self, endpoint):
-        self._subgraph_endpoint = endpoint
-        transport = AIOHTTPTransport(url=endpoint)
-        self._client = Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=120)
+def parse_position_id(position_id):
+    """Split position ID into (account, market, position type, counter),
+    ie. ('0x0000000000000d9054f605ca65a2647c2b521422', '0xb84c45174bfc6b8f3eaecbae11dee63114f5c1b2', 'INVESTMENT', 5)
+    for position '0x0000000000000d9054f605ca65a2647c2b521422-0xb84c45174bfc6b8f3eaecbae11dee63114f5c1b2-INVESTMENT-5'.
+    """
+    prefix, counter = position_id.rsplit('-', 1)
+    account, market, position_type = prefix.split('-', 2)
+    return account, market, position_type, int(counter)
+
+def index_positions(position_ids):
+    """Parse position IDs once into an index of position chains.
+    Return dict where key is (account, market, position type) and value dict of position IDs by counter, sorted by counter.
+    Chains are ordered the same way as position IDs sorted by account, market and counter.
+    """
+
+    chains = {}
+    for position_id in position_ids:
+        account, market, position_type, counter = parse_position_id(position_id)
+        key = (account, market, position_type)
+        if key not in chains: chains[key] = {}
+        chains[key][counter] = position_id
+
+    return {key: dict(sorted(chains[key].items())) for key in sorted(chains, key="-".join)}
+
+def order_positions(raw_positions):
+    """Return raw positions ordered by account, market and counter."""
+
+    return {position_id: raw_positions[position_id] for chain in index_positions(raw_positions).values() for position_id in chain.values()}
+
+class PositionHandler(GraphClient):
 
     def getAllEthMarkets(self):
         """Fetch all markets (Sushiswap pairs) where one input token is WETH.
         """
 
-        markets = {}
-        lastID = ""
-
-        while True:
-            vars = {"lastID": lastID}
-            query = self._load_query('queries/get_all_eth_markets.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['markets']:
-                break
-
-            for market in response['markets']:
-                markets[market['id']] = True
+        [rows] = Paginator(self).scan('queries/get_all_eth_markets.graphql', 'markets', [{}], "markets")
 
-            lastID = response['markets'][-1]['id']
-            print("Processed markets:", len(response["markets"]))
+        markets = {}
+        for market in rows:
+            markets[market['id']] = True
 
         return markets
 
@@ -41,65 +64,87 @@ class PositionHandler:
         """Fetch closed positions from the Sushiswap subgraph.
         Return a dictionary where key is position ID and value list of TXs.
         """
-        
-        raw_positions = {}
-        lastID = ""
-
-        while True:
-            vars = {"lastID": lastID, "market": market}
-            query = self._load_query('queries/get_raw_closed_positions.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['positions']:
-                break
-
-            for position in response['positions']:
-                raw_positions[position['id']] = []
-                for positionSnapshot in position['history']:
-                    tx = positionSnapshot['transaction']
-                    tx["accountAddress"] = position["accountAddress"]
-                    tx["blockNumber"] = int(tx["blockNumber"])
-                    raw_positions[position['id']].append(tx)
-
-            lastID = response['positions'][-1]['id']
-            print("Processed positions:", len(raw_positions))
-        
-        ordered_raw_positions = dict(sorted(raw_positions.items(), key=lambda item: (item[0].rsplit('-', 1)[0], int(item[0].split("-")[-1]))))
-        return ordered_raw_positions
 
-    def getAllRawClosedPositions(self):
+        return self.getRawClosedPositionsForMarkets([market])[market]
+
+    def getRawClosedPositionsForMarkets(self, markets, concurrency=DEFAULT_CONCURRENCY):
+        """Fetch closed positions of multiple markets, scanning all markets concurrently.
+        Return a dictionary where key is market and value dict of raw positions as returned by getRawClosedPositions.
+        """
+
+        vars_list = [{"market": market} for market in markets]
+        scans = Paginator(self, concurrency).scan('queries/get_raw_closed_positions.graphql', 'positions', vars_list, "positions")
+
+        raw_positions_by_market = {}
+        for market, rows in zip(markets, scans):
+            raw_positions = self._parseRawPositions(rows)
+            raw_positions_by_market[market] = order_positions(raw_positions)
+
+        return raw_positions_by_market
+
+    def getAllRawClosedPositions(self, shards=DEFAULT_SHARDS):
         """Fetch all closed positions from the Sushiswap subgraph, in ETH markets.
+        Position ID space is split into shards which are scanned in parallel.
         Return a dictionary where key is position ID and value list of TXs.
         """
         eth_markets = self.getAllEthMarkets()
         print("Found {0} ETH markets".format(len(eth_markets)))
 
-        raw_positions = {}
-        lastID = ""
-
-        while True:
-            vars = {"lastID": lastID}
-            query = self._load_query('queries/get_all_raw_closed_positions.graphql')
-            response = self._client.execute(query, variable_values=vars)
-            if not response['positions']:
-                break
-
-            for position in response['positions']:
-                raw_positions[position['id']] = []
-                for positionSnapshot in position['history']:
-                    tx = positionSnapshot['transaction']
-                    tx["accountAddress"] = position["accountAddress"]
-                    tx["blockNumber"] = int(tx["blockNumber"])
-                    raw_positions[position['id']].append(tx)
-
-            lastID = response['positions'][-1]['id']
-            print("Processed positions:", len(raw_positions))
+        rows = Paginator(self, shards).shardedScan('queries/get_all_raw_closed_positions.graphql', 'positions', {}, shards, "positions")
+        raw_positions = self._parseRawPositions(rows)
 
         raw_positions_in_weth_markets = {k:v for (k,v) in raw_positions.items() if k.split('-')[1] in eth_markets.keys()}
         print("All positions: ", len(raw_positions))
         print("Positions in WETH markets: ", len(raw_positions_in_weth_markets))
 
-        ordered_raw_positions_in_weth_markets = dict(sorted(raw_positions_in_weth_markets.items(), key=lambda item: (item[0].rsplit('-', 1)[0], int(item[0].split("-")[-1]))))
-        return ordered_raw_positions_in_weth_markets
+        return order_positions(raw_positions_in_weth_markets)
+
+    def iterAllRawClosedPositions(self, shards=DEFAULT_SHARDS):
+        """Streaming version of getAllRawClosedPositions: yield dicts of raw positions in ETH markets, ordered by ID.
+        Positions of an account/market chain always come in the same dict, so every dict can be merged on its own.
+        """
+        eth_markets = self.getAllEthMarkets()
+        print("Found {0} ETH markets".format(len(eth_markets)))
+
+        pages = Paginator(self, shards).iterShardedScan('queries/get_all_raw_closed_positions.graphql', 'positions', {}, shards, "positions")
+        for rows in complete_groups(pages, lambda row: row['id'].rsplit('-', 1)[0]):
+            raw_positions = self._parseRawPositions(row for row in rows if row['id'].split('-')[1] in eth_markets)
+            if raw_positions:
+                yield order_positions(raw_positions)
+
+    def iterAllMergedPositions(self, shards=DEFAULT_SHARDS):
+        """Yield (position ID, TXs) of merged positions in all ETH markets, as mergePositionsByHistory
+        of getAllRawClosedPositions would, while only a few pages of raw positions are held in memory.
+        """
+
+        for raw_positions in self.iterAllRawClosedPositions(shards):
+            yield from self.iterMergedPositions(raw_positions)
+
+    def getRawPositionsClosedSince(self, market, block, head_block, position_ids=()):
+        """Fetch positions of market closed after block, together with positions with given IDs
+        (ie. earlier parts of histories which weren't complete at block).
+        Data is read as of head_block, so the result doesn't change between runs.
+        Return a dictionary where key is position ID and value list of TXs.
+        """
+
+        paginator = Paginator(self)
+        vars = {"market": market, "closedAfter": block, "block": head_block}
+        [rows] = paginator.scan('queries/get_raw_positions_closed_since.graphql', 'positions', [vars], "positions")
+
+        position_ids = list(position_ids)
+        if position_ids:
+            vars_list = [{"ids": position_ids[i:i+1000], "block": head_block} for i in range(0, len(position_ids), 1000)]
+            for id_rows in paginator.scan('queries/get_raw_positions_by_ids.graphql', 'positions', vars_list, "pending positions"):
+                rows.extend(id_rows)
+
+        return order_positions(self._parseRawPositions(rows))
+
+    def _parseRawPositions(self, positions):
+        raw_positions = {}
+        for position in positions:
+            raw_positions[position['id']] = [
+                Transaction.fromSubgraph(positionSnapshot['transaction'], position["accountAddress"]) for positionSnapshot in position['history']]
+        return raw_positions
 
     def mergePositionsByHistory(self, raw_positions):
         """Merge positions which are part of same user history.
@@ -107,74 +152,72 @@ class PositionHandler:
         we want to connect it with the next position where user claims back his LP tokens and then redeems them.
         """
 
-        merged_positions = {}
-        processed_positions = {}
-
-        ordered_raw_positions = dict(sorted(raw_positions.items(), key=lambda item: (item[0].rsplit('-', 1)[0], int(item[0].split("-")[-1]))))
+        return dict(self.iterMergedPositions(raw_positions))
 
-        for position_id in ordered_raw_positions.keys():
-            # don't process position which was already processed as part of position merging
-            if processed_positions.get(position_id) == True:
-                continue
+    def iterMergedPositions(self, raw_positions, position_index=None, incomplete=None):
+        """Yield (position ID, TXs) of merged positions, ordered by account, market and counter.
+        Every account/market chain is walked once, so only the chain being merged is held in memory.
+        If incomplete list is given, IDs of positions whose history can still be completed by
+        a position closed later (LP tokens are in MasterChef) are appended to it.
+        """
 
-            txs = raw_positions[position_id]
-            first_tx = txs[0]
-            last_tx = txs[-1]
+        if position_index is None:
+            position_index = index_positions(raw_positions)
 
-            # first TX has to be of type INVEST
-            if first_tx['transactionType'] != "INVEST":
-                continue
+        for chain in position_index.values():
+            # positions up to this counter were already merged into a previous position of the chain
+            merged_until = None
 
-            # if last TX is REDEEM then position is completed
-            if last_tx['transactionType'] == "REDEEM":
-                # skip positions where LP tokens were transferred out somewhere else then masterchef 
-                if any((tx['transactionType'] == "TRANSFER_OUT" and tx["transferredTo"] not in MASTERCHEFS) for tx in txs):
+            for counter, position_id in chain.items():
+                if merged_until is not None and counter <= merged_until:
                     continue
 
-               # skip positions where LP tokens were transferred in from somewhere else then masterchef 
-                if any((tx['transactionType'] == "TRANSFER_IN" and tx["transferredFrom"] not in MASTERCHEFS) for tx in txs):
+                txs = raw_positions[position_id]
+                first_tx = txs[0]
+                last_tx = txs[-1]
+
+                # first TX has to be of type INVEST
+                if first_tx.transactionType != TxType.INVEST:
                     continue
 
-                merged_positions[position_id] = raw_positions[position_id]
-                processed_positions[position_id] = True
-                continue
+                # if last TX is REDEEM then position is completed
+                if last_tx.transactionType == TxType.REDEEM:
+                    # skip positions where LP tokens were transferred out somewhere else then masterchef 
+                    if any((tx.transactionType == TxType.TRANSFER_OUT and tx.transferredTo not in MASTERCHEF_IDS) for tx in txs):
+                        continue
 
-            # if last TX is TRANSFER_OUT (to masterchef) then search for subsequent TXs (by ID) to make position complete
-            if last_tx['transactionType'] == "TRANSFER_OUT" and last_tx["transferredTo"] in MASTERCHEFS:
-                expanded_position = raw_positions[position_id]
-                expanded_position_complete = False
+                   # skip positions where LP tokens were transferred in from somewhere else then masterchef 
+                    if any((tx.transactionType == TxType.TRANSFER_IN and tx.transferredFrom not in MASTERCHEF_IDS) for tx in txs):
+                        continue
 
-                # ie. 5 for position '0x0000000000000d9054f605ca65a2647c2b521422-0xb84c45174bfc6b8f3eaecbae11dee63114f5c1b2-INVESTMENT-5'
-                current_position_counter = int(position_id.split("-")[-1])
-                while True:
-                    # increase position ID by 1
-                    next_position_id = position_id.rsplit('-', 1)[0] + "-" + str(current_position_counter + 1)
-                    next_position = raw_positions.get(next_position_id)
+                    yield position_id, txs
+                    continue
 
-                    # if there's no next position don't add anything
-                    if next_position == None:
-                        break
-
-                    # if last TX is not REDEEM then loop again to pick up and merge next position
-                    elif next_position[-1]['transactionType'] != "REDEEM":
-                        current_position_counter = int(next_position_id.split("-")[-1])
-                        expanded_position = expanded_position + next_position
-                        processed_positions[next_position_id] = True
-                        continue
+                # if last TX is TRANSFER_OUT (to masterchef) then pick up subsequent positions of the chain to make position complete
+                if last_tx.transactionType == TxType.TRANSFER_OUT and last_tx.transferredTo in MASTERCHEF_IDS:
+                    expanded_position = list(txs)
+                    expanded_position_complete = False
+                    expanded_position_ids = [position_id]
 
-                    # position has been completed if last TX is REDEEM
-                    else:
-                        expanded_position = expanded_position + next_position
-                        expanded_position_complete = True
-                        processed_positions[next_position_id] = True
-                        break
-
-                # add completed position to list
-                if expanded_position_complete:
-                    merged_positions[position_id] = expanded_position
-                    processed_positions[position_id] = True
-        
-        return merged_positions
+                    next_counter = counter + 1
+                    # if there's no next position don't add anything
+                    while next_counter in chain:
+                        next_position = raw_positions[chain[next_counter]]
+                        expanded_position.extend(next_position)
+                        expanded_position_ids.append(chain[next_counter])
+                        merged_until = next_counter
+
+                        # position has been completed if last TX is REDEEM, otherwise loop again to pick up and merge next position
+                        if next_position[-1].transactionType == TxType.REDEEM:
+                            expanded_position_complete = True
+                            break
+                        next_counter += 1
+
+                    # add completed position to list
+                    if expanded_position_complete:
+                        yield position_id, expanded_position
+                    elif incomplete is not None:
+                        incomplete.extend(expanded_position_ids)
 
     def filterOutPositionsWithMultipleInvestsOrRedeems(self, positions):
         """Return positions which have 1 Invest and 1 Redeem TX """
@@ -182,8 +225,8 @@ class PositionHandler:
         filtered_positions = {}
         for position_id in positions.keys():
             txs = positions[position_id]
-            invest_count = sum(map(lambda x : x['transactionType'] == 'INVEST', txs))
-            redeem_count = sum(map(lambda x : x['transactionType'] == 'REDEEM', txs))
+            invest_count = sum(map(lambda x : x.transactionType == TxType.INVEST, txs))
+            redeem_count = sum(map(lambda x : x.transactionType == TxType.REDEEM, txs))
 
             if invest_count == 1 and redeem_count == 1:
                 filtered_positions[position_id] = positions[position_id]
@@ -195,24 +238,23 @@ class PositionHandler:
         """Return dict of position profitability stats.
         For every position calculate net gains, ROI gains and pool vs HODL. difference.
         """
-        start_time = time.time()
-
         price_provider = PriceProvider()
+        self._prefetchTokenMetadata(positions, price_provider)
         position_stats = {}
 
         ## collect all blocks
         blocks = set()
         for pos_id in positions.keys():
             txs = positions[pos_id]
-            blocks.update([tx['blockNumber'] for tx in txs if tx['transactionType'] == 'INVEST' or tx['transactionType'] == 'REDEEM'])
+            blocks.update([tx.blockNumber for tx in txs if tx.transactionType == TxType.INVEST or tx.transactionType == TxType.REDEEM])
 
         ## collect ETH prices
         prices = {}
         prices[WETH] = price_provider.getEthPriceinUSDForBlocks(blocks)
 
         ## extract input tokens
-        tokenA = positions[list(positions.keys())[0]][0]['inputTokenAmounts'][0].split("|")[0]
-        tokenB = positions[list(positions.keys())[0]][0]['inputTokenAmounts'][1].split("|")[0]
+        tokenA = positions[list(positions.keys())[0]][0].token(0)
+        tokenB = positions[list(positions.keys())[0]][0].token(1)
 
         ## collect prices for tokenA, tokenB
         prices[tokenA] = price_provider.getTokenPriceinUSDForBlocks(tokenA, blocks, prices[WETH])
@@ -251,8 +293,8 @@ class PositionHandler:
             claimed_rewards_in_USD = 0
             if pos_id in farm_transactions:
                 for farm_tx in farm_transactions[pos_id]:
-                    for reward in farm_tx["rewardTokenAmounts"]:
-                        claimed_rewards_in_USD = claimed_rewards_in_USD + reward["valueInUSD"]
+                    for reward_value in farm_tx.rewardValuesInUSD:
+                        claimed_rewards_in_USD = claimed_rewards_in_USD + reward_value
 
             ## write stats
             position_stats[pos_id] = {
@@ -276,59 +318,41 @@ class PositionHandler:
                 'position_trade_counter': len(txs)
             }
 
-            if(len(position_stats.keys()) % 10 == 0):
-                print(len(position_stats.keys()))
-
-        end_time = time.time()
-
-        print("--- %s seconds ---" % (end_time - start_time))
-
+        metrics.increment(POSITIONS, len(positions))
         return position_stats
 
 
-    def calculateProfitabilityOfAllPositions(self, positions, farm_transactions):
+    def calculateProfitabilityOfAllPositions(self, positions, farm_transactions, price_provider=None):
         """Return dict of position profitability stats.
         For every position calculate net gains, ROI gains and pool vs HODL. difference.
+        Price provider can be shared by calls on batches of positions.
         """
-        start_time = time.time()
-
-        price_provider = PriceProvider()
+        if price_provider is None:
+            price_provider = PriceProvider()
+        self._prefetchTokenMetadata(positions, price_provider)
         position_stats = {}
 
-        ## collect all blocks
+        ## plan prices: blocks where every token is invested or redeemed, in one pass over positions
+        token_blocks = self._planTokenPrices(positions)
         all_blocks = set()
-        for pos_id in positions.keys():
-            txs = positions[pos_id]
-            all_blocks.update([tx['blockNumber'] for tx in txs if tx['transactionType'] == 'INVEST' or tx['transactionType'] == 'REDEEM'])
+        for blocks in token_blocks.values():
+            all_blocks.update(blocks)
 
         ## collect ETH prices
         print("Collect ETH prices")
         prices = {}
         prices[WETH] = price_provider.getEthPriceinUSDForBlocks(all_blocks)
 
+        ## collect prices of all the other tokens, only for their own blocks
+        prices.update(self._fetchTokenPrices(price_provider, token_blocks, prices[WETH]))
+
         ## do calcs for every position
         for pos_id in positions.keys():
             txs = positions[pos_id]
 
             ## extract input tokens
-            tokenA = txs[0]['inputTokenAmounts'][0].split("|")[0]
-            tokenB = txs[0]['inputTokenAmounts'][1].split("|")[0]
-
-            ## get tokenA prices
-            if prices.get(tokenA) == None:
-                blocks = set()
-                for pos_id in positions.keys():
-                    txs = positions[pos_id]
-                    blocks.update([tx['blockNumber'] for tx in txs if tx['transactionType'] == 'INVEST' or tx['transactionType'] == 'REDEEM'])
-                prices[tokenA] = price_provider.getTokenPriceinUSDForBlocks(tokenA, blocks, prices[WETH])
-
-            ## get tokenB prices
-            if prices.get(tokenB) == None:
-                blocks = set()
-                for pos_id in positions.keys():
-                    txs = positions[pos_id]
-                    blocks.update([tx['blockNumber'] for tx in txs if tx['transactionType'] == 'INVEST' or tx['transactionType'] == 'REDEEM'])
-                prices[tokenB] = price_provider.getTokenPriceinUSDForBlocks(tokenB, blocks, prices[WETH])
+            tokenA = txs[0].token(0)
+            tokenB = txs[0].token(1)
 
             ## get position start/end info
             position_start_block, position_end_block, position_start_date, position_end_date = self._getPositionTimestamps(txs)
@@ -359,8 +383,8 @@ class PositionHandler:
             claimed_rewards_in_USD = 0
             if pos_id in farm_transactions:
                 for farm_tx in farm_transactions[pos_id]:
-                    for reward in farm_tx["rewardTokenAmounts"]:
-                        claimed_rewards_in_USD = claimed_rewards_in_USD + reward["valueInUSD"]
+                    for reward_value in farm_tx.rewardValuesInUSD:
+                        claimed_rewards_in_USD = claimed_rewards_in_USD + reward_value
 
             ## write stats
             position_stats[pos_id] = {
@@ -384,19 +408,42 @@ class PositionHandler:
                 'position_trade_counter': len(txs)
             }
 
-            if(len(position_stats.keys()) % 10 == 0):
-                print(len(position_stats.keys()))
+        metrics.increment(POSITIONS, len(positions))
+        return position_stats
 
-        end_time = time.time()
+    def _planTokenPrices(self, positions):
+        """Return dict where key is input token and value set of blocks where the token is invested or redeemed."""
 
-        print("--- %s seconds ---" % (end_time - start_time))
+        token_blocks = {}
+        for txs in positions.values():
+            blocks = [tx.blockNumber for tx in txs if tx.transactionType == TxType.INVEST or tx.transactionType == TxType.REDEEM]
+            for token in (txs[0].token(0), txs[0].token(1)):
+                if token not in token_blocks: token_blocks[token] = set()
+                token_blocks[token].update(blocks)
+        return token_blocks
 
-        return position_stats
+    def _fetchTokenPrices(self, price_provider, token_blocks, eth_prices):
+        """Fetch prices of all tokens except WETH for their blocks, PRICE_CONCURRENCY tokens at a time.
+        Return dict where key is token and value dict of prices by block.
+        """
+
+        tokens = [token for token in token_blocks if token != WETH]
+        price_provider.prefetchPriceSnapshots(token_blocks)
+        messages = {token: [] for token in tokens}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PRICE_CONCURRENCY) as executor:
+            futures = {token: executor.submit(price_provider.getTokenPriceinUSDForBlocks, token, token_blocks[token], eth_prices, messages[token]) for token in tokens}
 
-    def writeProfitabilityStatsToCsv(self, stats, filename):
-        """Write all the collected info to CSV file"""
+        ## workers collect their progress messages, print them in submission order so they don't interleave
+        for token in tokens:
+            for message in messages[token]:
+                print(message)
+        return {token: future.result() for token, future in futures.items()}
 
-        f = open(filename, "w")
+    def writeProfitabilityStatsToCsv(self, stats, filename, append=False):
+        """Write all the collected info to CSV file, or append it to existing file"""
+
+        append = append and os.path.isfile(filename)
+        f = open(filename, "a" if append else "w")
         writer = csv.DictWriter(f, fieldnames=[
                 'market',
                 'account',
@@ -417,33 +464,47 @@ class PositionHandler:
                 'claimed_rewards_in_USD',
                 'position_trade_counter'
         ])
-        writer.writeheader()
+        if not append:
+            writer.writeheader()
 
         for position_id in stats.keys():
             writer.writerow(stats[position_id])
         f.close()
 
-    def _load_query(self, path):
-        with open(path) as f:
-            return gql(f.read())
+    def writeProfitabilityStatsToParquet(self, stats, folder, append=False):
+        """Write all the collected info to Parquet dataset in folder, partitioned by market"""
+
+        stats_dataset.write_stats(stats, folder, append)
+
+    def _prefetchTokenMetadata(self, positions, price_provider):
+        """Load metadata of all input tokens at once and store input tokens of every market."""
+
+        markets = {}
+        for position_id, txs in positions.items():
+            market = position_id.split("-")[1]
+            if market not in markets:
+                markets[market] = (txs[0].token(0), txs[0].token(1))
+
+        price_provider.prefetchTokens(token for tokens in markets.values() for token in tokens)
+        token_store.putMarkets(markets)
 
     def _sumInvestments(self, txs, prices, tokenA, tokenB, price_provider):
         position_investment_value = 0
-        investTXs = [tx for tx in txs if tx['transactionType'] == 'INVEST']
+        investTXs = [tx for tx in txs if tx.transactionType == TxType.INVEST]
 
         tokenA_total_amount_invested = 0
         tokenB_total_amount_invested = 0
         for tx in investTXs:
-            block = int(tx['blockNumber'])
+            block = tx.blockNumber
 
-            tokenA_amount = int(tx['inputTokenAmounts'][0].split("|")[2]) * pow(10, (-1) * price_provider.decimals(tokenA))
+            tokenA_amount = tx.inputAmounts[0] * pow(10, (-1) * price_provider.decimals(tokenA))
             tokenA_price = prices[tokenA][block]
             if(tokenA_price == None):
                 continue
             position_investment_value += tokenA_amount * tokenA_price
             tokenA_total_amount_invested += tokenA_amount
 
-            tokenB_amount = int(tx['inputTokenAmounts'][1].split("|")[2]) * pow(10, (-1) * price_provider.decimals(tokenB))
+            tokenB_amount = tx.inputAmounts[1] * pow(10, (-1) * price_provider.decimals(tokenB))
             tokenB_price = prices[tokenB][block]
             if(tokenB_price == None):
                 continue
@@ -453,21 +514,21 @@ class PositionHandler:
         return position_investment_value, tokenA_total_amount_invested, tokenB_total_amount_invested
 
     def _sumRedemptions(self, txs, prices, tokenA, tokenB, price_provider):
-        redeemTXs = [tx for tx in txs if tx['transactionType'] == 'REDEEM']
+        redeemTXs = [tx for tx in txs if tx.transactionType == TxType.REDEEM]
         position_redemption_value = 0
 
         tokenA_price = 0
         tokenB_price = 0
         for tx in redeemTXs:
-            block = int(tx['blockNumber'])
+            block = tx.blockNumber
 
-            tokenA_amount = int(tx['inputTokenAmounts'][0].split("|")[2]) * pow(10, (-1) * price_provider.decimals(tokenA))
+            tokenA_amount = tx.inputAmounts[0] * pow(10, (-1) * price_provider.decimals(tokenA))
             tokenA_price = prices[tokenA][block]
             if(tokenA_price == None):
                 continue
             position_redemption_value += tokenA_amount * tokenA_price
 
-            tokenB_amount = int(tx['inputTokenAmounts'][1].split("|")[2]) * pow(10, (-1) * price_provider.decimals(tokenB))
+            tokenB_amount = tx.inputAmounts[1] * pow(10, (-1) * price_provider.decimals(tokenB))
             tokenB_price = prices[tokenB][block]
             if(tokenB_price == None):
                 continue
@@ -476,11 +537,11 @@ class PositionHandler:
         return position_redemption_value, tokenA_price, tokenB_price
 
     def _getPositionTimestamps(self, txs):
-        position_start_block = txs[0]['blockNumber']
-        position_end_block = txs[-1]['blockNumber']
-        start_timestamp = int(txs[0]['timestamp'])
+        position_start_block = txs[0].blockNumber
+        position_end_block = txs[-1].blockNumber
+        start_timestamp = txs[0].timestamp
         position_start_date = datetime.strftime(datetime.fromtimestamp(start_timestamp), '%Y-%m-%d')
-        end_timestamp = int(txs[-1]['timestamp'])
+        end_timestamp = txs[-1].timestamp
         position_end_date = datetime.strftime(datetime.fromtimestamp(end_timestamp), '%Y-%m-%d')
 
         return position_start_block,position_end_block,position_start_date,position_end_date
\ No newline at end of file
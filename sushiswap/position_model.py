@@ -0,0 +1,133 @@
+import sys
+import threading
+from enum import IntEnum
+
+
+class TxType(IntEnum):
+    """Position transaction types of SimpleFi subgraphs."""
+
+    INVEST = 0
+    REDEEM = 1
+    BORROW = 2
+    REPAY = 3
+    TRANSFER_IN = 4
+    TRANSFER_OUT = 5
+
+
+class AddressTable:
+    """Addresses interned to small integer IDs.
+    Every address is stored once per process, transactions only keep its ID.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._addresses = []
+        self._lock = threading.Lock()
+
+    def intern(self, address):
+        """Return ID of address, adding it to the table if it's new. None stays None."""
+
+        if address is None:
+            return None
+        address_id = self._ids.get(address)
+        if address_id is None:
+            with self._lock:
+                address_id = self._ids.get(address)
+                if address_id is None:
+                    address_id = len(self._addresses)
+                    self._addresses.append(address)
+                    self._ids[address] = address_id
+        return address_id
+
+    def address(self, address_id):
+        """Return address for ID. None stays None."""
+
+        if address_id is None:
+            return None
+        return self._addresses[address_id]
+
+
+address_table = AddressTable()
+
+
+def parse_token_amounts(token_amounts):
+    """Parse subgraph token balances, ie. ['0xc02a...|WETH|1000000000000000000'],
+    into tuple of token IDs and tuple of integer amounts.
+    """
+
+    tokens = []
+    amounts = []
+    for token_amount in token_amounts:
+        token, _symbol, amount = token_amount.split("|")
+        tokens.append(address_table.intern(token))
+        amounts.append(int(amount))
+    return tuple(tokens), tuple(amounts)
+
+
+class Transaction:
+    """Position transaction parsed once at ingestion.
+    Addresses are IDs from address_table and amounts are integers in token's smallest unit.
+    """
+
+    __slots__ = (
+        "id",
+        "blockNumber",
+        "timestamp",
+        "transactionType",
+        "transactionHash",
+        "accountAddress",
+        "marketId",
+        "inputTokens",
+        "inputAmounts",
+        "rewardTokens",
+        "rewardAmounts",
+        "rewardValuesInUSD",
+        "transferredTo",
+        "transferredFrom",
+    )
+
+    # slots which hold address IDs, they are pickled as addresses so records can be shared between processes
+    _ADDRESS_SLOTS = ("accountAddress", "transferredTo", "transferredFrom")
+    _TOKEN_SLOTS = ("inputTokens", "rewardTokens")
+
+    @classmethod
+    def fromSubgraph(cls, tx, account_address, market_id=None):
+        """Create transaction from a 'transaction' object of the positions query."""
+
+        transaction = cls()
+        transaction.id = tx["id"]
+        transaction.blockNumber = int(tx["blockNumber"])
+        transaction.timestamp = int(tx["timestamp"])
+        transaction.transactionType = TxType[tx["transactionType"]]
+        transaction.transactionHash = tx["transactionHash"]
+        transaction.accountAddress = address_table.intern(account_address)
+        transaction.marketId = sys.intern(market_id) if market_id is not None else None
+        transaction.inputTokens, transaction.inputAmounts = parse_token_amounts(tx["inputTokenAmounts"])
+        transaction.rewardTokens, transaction.rewardAmounts = parse_token_amounts(tx["rewardTokenAmounts"] or [])
+        transaction.rewardValuesInUSD = None
+        transaction.transferredTo = address_table.intern(tx["transferredTo"])
+        transaction.transferredFrom = address_table.intern(tx["transferredFrom"])
+        return transaction
+
+    def token(self, index):
+        """Return address of input token at index."""
+        return address_table.address(self.inputTokens[index])
+
+    def __getstate__(self):
+        state = {slot: getattr(self, slot) for slot in self.__slots__}
+        for slot in self._ADDRESS_SLOTS:
+            state[slot] = address_table.address(state[slot])
+        for slot in self._TOKEN_SLOTS:
+            state[slot] = tuple(address_table.address(token) for token in state[slot])
+        return state
+
+    def __setstate__(self, state):
+        for slot in self._ADDRESS_SLOTS:
+            state[slot] = address_table.intern(state[slot])
+        for slot in self._TOKEN_SLOTS:
+            state[slot] = tuple(address_table.intern(token) for token in state[slot])
+        for slot, value in state.items():
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return "Transaction({0} {1} at block {2})".format(self.id, self.transactionType.name, self.blockNumber)
@@ -1,17 +1,29 @@
-from gql import gql, Client
-from gql.transport.aiohttp import AIOHTTPTransport
+import os
 
-SUSHISWAP_ENDPOINT = "https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap"
+import numpy as np
+
+from subgraph_client import GraphClient
+from price_store import price_store
+from token_store import token_store
+from snapshot_index import get_snapshot_index, prefetch_snapshots
+from price_router import PriceRouter
+
+# Endpoints can point at another server, ie. the local stand-in of subgraph_server.py
+SUSHISWAP_ENDPOINT = os.environ.get("SUSHISWAP_ENDPOINT", "https://api.thegraph.com/subgraphs/name/simplefi-finance/sushiswap")
 USDC_ETH_PAIR = "0x397ff1542f962076d0bfe58ea045ffa2d347aca0"
 WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
 WETH_DECIMALS = 18
 USDC = "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48"
 USDC_DECIMALS = 6
 
-class PriceProvider:
-    def __init__(self):
-        transport = AIOHTTPTransport(url=SUSHISWAP_ENDPOINT)
-        self._client = Client(transport=transport, fetch_schema_from_transport=True, execute_timeout=120)
+# Shared by all price providers, market graph is loaded on first token without WETH pair
+price_router = PriceRouter(SUSHISWAP_ENDPOINT)
+
+class PriceProvider(GraphClient):
+    def __init__(self, store=None, tokens=None):
+        super().__init__(SUSHISWAP_ENDPOINT)
+        self._price_store = store if store is not None else price_store
+        self._token_store = tokens if tokens is not None else token_store
         self._decimals = {}
         self._decimals[WETH] = WETH_DECIMALS
         self._decimals[USDC] = USDC_DECIMALS
@@ -23,9 +35,8 @@ class PriceProvider:
         Sushiswap subgraph is used to fetch WETH-USDC pool reserves.
         """
 
-        query = self._load_query('queries/pair_reserves.graphql')
         vars = {"block": block, "market": USDC_ETH_PAIR}
-        response = self._client.execute(query, variable_values=vars)
+        response = self.runQuery('queries/pair_reserves.graphql', vars)
 
         if response['market'] is None:
             return 0
@@ -55,9 +66,8 @@ class PriceProvider:
             #TODO use some other pair
             return None
 
-        query = self._load_query('queries/pair_reserves.graphql')
         vars = {"block": block, "market": weth_pair}
-        response = self._client.execute(query, variable_values=vars)
+        response = self.runQuery('queries/pair_reserves.graphql', vars)
 
         if response['market'] is None:
             return 0
@@ -79,102 +89,201 @@ class PriceProvider:
             return token_price_in_usd
     
     def getMarketSnapshotsForBlocks(self, market, blocks):
-        blocks = sorted(set(blocks))
-        snapshots = {}
-        query = self._load_query('queries/pair_reserves_blocks.graphql')
-        firstSnapshot = None
-        n = 100
-
-        for i in range(0, len(blocks), n):
-            vars = {"market": market, "blocks": blocks[i:i+n]}
-            response = self._client.execute(query, variable_values=vars)
-            if response["marketSnapshots"] and firstSnapshot == None:
-                firstSnapshot = response["marketSnapshots"][0]
-            for snapshot in response["marketSnapshots"]:
-                snapshots[int(snapshot["blockNumber"])] = snapshot
-        
-        lastSnapshot = firstSnapshot
-        for block in blocks:
-            if not block in snapshots:
-                snapshots[block] = lastSnapshot
-            else:
-                lastSnapshot = snapshots[block]
-
-        return snapshots
-
-    def getEthPriceinUSDForBlocks(self, blocks):
-        """Calculate ETH price in USD for all blocks between given start and end block.
-        Sushiswap subgraph is used to fetch WETH-USDC pool reserves.
+        """Return dict where key is block and value is the latest market snapshot at or before that block.
+        Value is None for blocks before the first snapshot of the market.
         """
-        print("Collect ETH prices...")
+        return get_snapshot_index(self, market).lookup(blocks)
 
+    def getEthPriceinUSDForBlocks(self, blocks, messages=None):
+        """Calculate ETH price in USD for all blocks between given start and end block.
+        Prices are read from the price store, only blocks without stored price are fetched from the subgraph.
+        """
         blocks = sorted(set(blocks))
-        marketSnapshots = self.getMarketSnapshotsForBlocks(USDC_ETH_PAIR, blocks)
+        eth_prices = self._price_store.getPrices(WETH, blocks)
 
-        if not marketSnapshots:
-            return {}
+        missing_blocks = [block for block in blocks if block not in eth_prices]
+        if missing_blocks:
+            fetched_prices = self._fetchEthPriceinUSDForBlocks(missing_blocks, messages)
+            self._price_store.putPrices(WETH, fetched_prices)
+            eth_prices.update(fetched_prices)
 
-        eth_prices = {}
-        for block in blocks:
-            reserves = marketSnapshots[block]['inputTokenBalances']
-            tokenA = reserves[0].split("|")[0]
-            tokenA_reserve = int(reserves[0].split("|")[2])
-            tokenB_reserve = int(reserves[1].split("|")[2])
-
-            if(tokenA == WETH):
-                eth_prices[block] = (tokenB_reserve * pow(10, (-1) * USDC_DECIMALS)) / (tokenA_reserve * pow(10, (-1) * WETH_DECIMALS))
-            else:
-                eth_prices[block] = (tokenA_reserve * pow(10, (-1) * USDC_DECIMALS)) / (tokenB_reserve * pow(10, (-1) * WETH_DECIMALS))
-          
         return eth_prices
 
-    def getTokenPriceinUSDForBlocks(self, token, blocks, eth_prices):
+    def getTokenPriceinUSDForBlocks(self, token, blocks, eth_prices, messages=None):
         """Calculate custom token price in USD for all blocks between given start and end block.
-        Sushiswap subgraph is used to fetch token reserves.
+        Prices are read from the price store, only blocks without stored price are fetched from the subgraph.
+        messages - list progress messages are appended to instead of printed, for calls from worker threads
         """
         blocks = sorted(set(blocks))
 
         ## collect ETH prices if empty dict is provided
         if len(eth_prices) == 0:
-            eth_prices = self.getEthPriceinUSDForBlocks(blocks)
+            eth_prices = self.getEthPriceinUSDForBlocks(blocks, messages)
         if token == WETH:
             return eth_prices
 
-        weth_pair = self.getWethPairForToken(token)
+        token_prices = self._price_store.getPrices(token, blocks)
 
-        if weth_pair is None:
-            #TODO use some other pair
-            print("WETH pair not found for token", token)
-            return None
+        missing_blocks = [block for block in blocks if block not in token_prices]
+        if missing_blocks:
+            fetched_prices = self._fetchTokenPriceinUSDForBlocks(token, missing_blocks, eth_prices, messages)
+            if fetched_prices is None:
+                return None
+            self._price_store.putPrices(token, fetched_prices)
+            token_prices.update(fetched_prices)
 
-        print("Collect", token, "prices...")
+        return token_prices
 
-        marketSnapshots = self.getMarketSnapshotsForBlocks(weth_pair, blocks)
+    def _fetchEthPriceinUSDForBlocks(self, blocks, messages=None):
+        """Calculate ETH price in USD for given blocks.
+        Sushiswap subgraph is used to fetch WETH-USDC pool reserves.
+        """
+        self._progress(messages, "Collect ETH prices...")
+
+        marketSnapshots = self.getMarketSnapshotsForBlocks(USDC_ETH_PAIR, blocks)
 
         if not marketSnapshots:
             return {}
 
-        token_prices = {}
-        for block in blocks:
-            reserves = marketSnapshots[block]['inputTokenBalances']
-            tokenA = reserves[0].split("|")[0]
-            tokenA_reserve = int(reserves[0].split("|")[2])
+        [tokenA, _], tokenA_reserves, tokenB_reserves, snapshot_index = self._parseSnapshots(marketSnapshots, blocks)
+        if tokenA is None:
+            return {block: None for block in blocks}
+
+        if tokenA == WETH:
+            prices = self._reserveRatio(tokenB_reserves, tokenA_reserves, WETH_DECIMALS - USDC_DECIMALS)
+        else:
+            prices = self._reserveRatio(tokenA_reserves, tokenB_reserves, WETH_DECIMALS - USDC_DECIMALS)
+
+        return self._pricesByBlock(blocks, prices[snapshot_index])
+
+    def _fetchTokenPriceinUSDForBlocks(self, token, blocks, eth_prices, messages=None):
+        """Calculate custom token price in USD for given blocks.
+        Sushiswap subgraph is used to fetch token reserves. Tokens without WETH pair are priced
+        along the most liquid route of markets leading to WETH.
+        """
+        route = self._route(token)
+
+        if route is None:
+            self._progress(messages, "WETH pair not found for token " + token)
+            return None
+
+        self._progress(messages, "Collect " + token + " prices...")
+
+        token_prices_in_eth = np.ones(len(blocks), dtype=np.float64)
+        for market, hop_token, next_token in route:
+            token_prices_in_eth *= self._getHopPricesForBlocks(market, hop_token, next_token, blocks)
+
+        eth_prices_for_blocks = np.array([eth_prices[block] for block in blocks], dtype=np.float64)
+        token_prices = token_prices_in_eth * eth_prices_for_blocks
+
+        return self._pricesByBlock(blocks, token_prices)
+
+    def _progress(self, messages, message):
+        """Print progress message, or append it to messages if given."""
 
-            tokenB = reserves[1].split("|")[0]
-            tokenB_reserve = int(reserves[1].split("|")[2])
+        if messages is None:
+            print(message)
+        else:
+            messages.append(message)
+
+    def _route(self, token):
+        """Return list of hops (market, token, next token) to price token in WETH, or None if there's no route."""
+
+        weth_pair = self.getWethPairForToken(token)
+        if weth_pair is not None:
+            return [(weth_pair, token, WETH)]
+        return price_router.getRoute(token)
+
+    def prefetchPriceSnapshots(self, token_blocks):
+        """Fetch snapshots of all the markets needed to price tokens at their blocks, several markets per request,
+        so that getTokenPriceinUSDForBlocks doesn't query markets one by one.
+        token_blocks - dict where key is token and value list of blocks
+        """
 
-            if tokenA_reserve == 0 or tokenB_reserve == 0:
-                token_prices[block] = 0
+        token_blocks = {token: blocks for token, blocks in token_blocks.items() if token != WETH and blocks}
+        self.prefetchWethPairs(token_blocks.keys())
+
+        ranges = {}
+        for token, blocks in token_blocks.items():
+            blocks = sorted(set(blocks))
+            stored_prices = self._price_store.getPrices(token, blocks)
+            missing_blocks = [block for block in blocks if block not in stored_prices]
+            if not missing_blocks:
                 continue
 
-            if(tokenA == WETH):
-                token_price_in_eth = (tokenA_reserve * pow(10, (-1) * self.decimals(WETH))) /(tokenB_reserve * pow(10, (-1) * self.decimals(tokenB)))
-            else:
-                token_price_in_eth = (tokenB_reserve * pow(10, (-1) * self.decimals(WETH))) / (tokenA_reserve * pow(10, (-1) * self.decimals(tokenA)))
+            for market, _, _ in self._route(token) or []:
+                from_block, to_block = ranges.get(market, (missing_blocks[0], missing_blocks[-1]))
+                ranges[market] = (min(from_block, missing_blocks[0]), max(to_block, missing_blocks[-1]))
 
-            token_prices[block] = token_price_in_eth * eth_prices[block]
-        
-        return token_prices
+        prefetch_snapshots(self, ranges)
+
+    def _getHopPricesForBlocks(self, market, token, next_token, blocks):
+        """Return array of token prices denominated in next_token, for every block.
+        Snapshots of the market are shared with any other route going through the same market.
+        """
+
+        marketSnapshots = self.getMarketSnapshotsForBlocks(market, blocks)
+        [tokenA, _], tokenA_reserves, tokenB_reserves, snapshot_index = self._parseSnapshots(marketSnapshots, blocks)
+
+        decimals_shift = self.decimals(token) - self.decimals(next_token)
+        if tokenA == token:
+            prices = self._reserveRatio(tokenB_reserves, tokenA_reserves, decimals_shift)
+        else:
+            prices = self._reserveRatio(tokenA_reserves, tokenB_reserves, decimals_shift)
+
+        return prices[snapshot_index]
+
+    def _parseSnapshots(self, marketSnapshots, blocks):
+        """Parse reserves of every distinct snapshot only once.
+        Return input tokens of the pair, integer reserve arrays with one entry per distinct snapshot
+        and array with index of the snapshot used for every block. Blocks without snapshot point to
+        an extra entry with zero reserves at the end of the arrays.
+        """
+
+        snapshot_positions = {}
+        tokenA_reserves = []
+        tokenB_reserves = []
+        snapshot_index = np.empty(len(blocks), dtype=np.int64)
+        tokens = [None, None]
+
+        for i, block in enumerate(blocks):
+            snapshot = marketSnapshots[block]
+            if snapshot is None:
+                snapshot_index[i] = -1
+                continue
+
+            position = snapshot_positions.get(snapshot['id'])
+            if position is None:
+                position = len(tokenA_reserves)
+                snapshot_positions[snapshot['id']] = position
+
+                reserves = [balance.split("|") for balance in snapshot['inputTokenBalances']]
+                tokens = [reserves[0][0], reserves[1][0]]
+                tokenA_reserves.append(int(reserves[0][2]))
+                tokenB_reserves.append(int(reserves[1][2]))
+            snapshot_index[i] = position
+
+        # missing snapshots point to the last entry
+        tokenA_reserves.append(0)
+        tokenB_reserves.append(0)
+
+        # python ints kept in object arrays, so reserves stay exact until the final scaling
+        return tokens, np.array(tokenA_reserves, dtype=object), np.array(tokenB_reserves, dtype=object), snapshot_index
+
+    def _reserveRatio(self, numerators, denominators, decimals_shift):
+        """Return numerators / denominators * 10^decimals_shift as float array.
+        Ratio is 0 where either of reserves is 0, and NaN for the last entry which stands for a missing snapshot.
+        """
+
+        valid = (numerators != 0).astype(bool) & (denominators != 0).astype(bool)
+        ratio = np.zeros(len(numerators), dtype=np.float64)
+        ratio[valid] = (numerators[valid] / denominators[valid]).astype(np.float64)
+        ratio[-1] = np.nan
+        return ratio * pow(10.0, decimals_shift)
+
+    def _pricesByBlock(self, blocks, prices):
+        """Return dict of prices by block, with None for unknown (NaN) prices."""
+        return {block: (None if price != price else price) for block, price in zip(blocks, prices.tolist())}
 
     def getWethPairForToken(self, token):
         """Find a WETH pair for token, if exists.
@@ -185,9 +294,8 @@ class PriceProvider:
         if weth_pair != None:
             return weth_pair
 
-        query = self._load_query('queries/get_eth_pair_for_token.graphql')
         vars = {"token": token}
-        response = self._client.execute(query, variable_values=vars)
+        response = self.runQuery('queries/get_eth_pair_for_token.graphql', vars)
 
         if response['markets'] == None or len(response['markets']) == 0:
             return None
@@ -198,32 +306,56 @@ class PriceProvider:
         return weth_pair
 
 
+    def prefetchWethPairs(self, tokens, batch_size=100):
+        """Find WETH pairs of all given tokens, batch_size tokens per request as aliased sub-queries."""
+
+        tokens = sorted(token for token in set(tokens) if token != WETH and token not in self._weth_pairs)
+        for i in range(0, len(tokens), batch_size):
+            batch = tokens[i:i+batch_size]
+            definitions = ", ".join("$t{0}: String!".format(j) for j in range(len(batch)))
+            fields = "\n  ".join(
+                'p{0}: markets(where: {{ inputTokens_contains: ["{1}", $t{0}] }}) {{ id }}'.format(j, WETH) for j in range(len(batch)))
+            vars = {"t%d" % j: token for j, token in enumerate(batch)}
+
+            response = self.runDocument('get_eth_pairs_for_tokens', "query ({0}) {{\n  {1}\n}}".format(definitions, fields), vars)
+            for j, token in enumerate(batch):
+                markets = response["p%d" % j]
+                if markets:
+                    self._weth_pairs[token] = markets[0]['id']
+
     def decimals(self, token_address):
         """Get number of decimals for token.
         Query subgraph if info is not stored locally.
         """
 
-        num_of_decimals = self._decimals.get(token_address)
-        if num_of_decimals != None:
-            return num_of_decimals
+        if token_address not in self._decimals:
+            self.prefetchTokens([token_address])
 
-        query = self._load_query('queries/get_token_decimals.graphql')
-        vars = {"id": token_address}
-        response = self._client.execute(query, variable_values=vars)
+        return self._decimals.get(token_address)
 
-        if response['token'] == None:
-            self._decimals[token_address] = None
-            return None
-
-        num_of_decimals = response['token']['decimals']
-        self._decimals[token_address] = num_of_decimals
-
-        return num_of_decimals
+    def prefetchTokens(self, token_addresses):
+        """Load metadata of all given tokens, so decimals() doesn't need to query them one by one.
+        Tokens which are not in the token store are fetched in bulk and stored.
+        """
 
+        unknown_tokens = set(token_addresses) - set(self._decimals.keys())
+        if not unknown_tokens:
+            return
 
-    def _load_query(self, path):
-        with open(path) as f:
-            return gql(f.read())
+        tokens = self._token_store.getTokens(unknown_tokens)
 
+        missing_tokens = sorted(unknown_tokens - set(tokens.keys()))
+        if missing_tokens:
+            fetched_tokens = {token: None for token in missing_tokens}
+            n = 1000
+            for i in range(0, len(missing_tokens), n):
+                vars = {"ids": missing_tokens[i:i+n]}
+                response = self.runQuery('queries/get_tokens.graphql', vars)
+                for token in response['tokens']:
+                    fetched_tokens[token['id']] = {"name": token['name'], "symbol": token['symbol'], "decimals": token['decimals']}
 
+            self._token_store.putTokens(fetched_tokens)
+            tokens.update({token: metadata or {} for token, metadata in fetched_tokens.items()})
 
+        for token, metadata in tokens.items():
+            self._decimals[token] = metadata.get("decimals")
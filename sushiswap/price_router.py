@@ -0,0 +1,78 @@
+import heapq
+import threading
+from collections import defaultdict
+
+from pagination import Paginator
+from subgraph_client import GraphClient
+
+WETH = "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2"
+
+class PriceRouter:
+    """Routes to WETH for tokens without a direct WETH pair.
+    Market list is loaded once and turned into a token graph where every market is an edge weighted by its liquidity.
+    Best route of a token is the one whose least liquid hop is the most liquid, it's found once for all tokens.
+    """
+
+    def __init__(self, endpoint):
+        self._client = GraphClient(endpoint)
+        self._routes = None
+        self._lock = threading.Lock()
+
+    def getRoute(self, token):
+        """Return list of hops (market, token, next token) leading from token to WETH.
+        Return None if token isn't connected to WETH through any market.
+        """
+
+        # routes are found once, even if tokens are priced from multiple threads
+        with self._lock:
+            if self._routes is None:
+                self._routes = self._findRoutes(self._loadMarkets())
+        return self._routes.get(token)
+
+    def _loadMarkets(self):
+        """Return list of (market, tokenA, tokenB, tokenA reserve, tokenB reserve) of all 2 token markets."""
+
+        [rows] = Paginator(self._client).scan('queries/get_all_markets_with_balances.graphql', 'markets', [{}], "markets")
+
+        markets = []
+        for market in rows:
+            balances = [balance.split("|") for balance in market["inputTokenTotalBalances"]]
+            if len(balances) != 2:
+                continue
+            markets.append((market["id"], balances[0][0], balances[1][0], int(balances[0][2]), int(balances[1][2])))
+
+        return markets
+
+    def _findRoutes(self, markets):
+        """Find the widest route to WETH for every token, Dijkstra style starting from WETH.
+        Liquidity of a market is the value of its reserves in WETH, using spot prices of the route found so far.
+        """
+
+        neighbours = defaultdict(list)
+        for market, tokenA, tokenB, tokenA_reserve, tokenB_reserve in markets:
+            if tokenA_reserve == 0 or tokenB_reserve == 0:
+                continue
+            neighbours[tokenA].append((market, tokenB, tokenA_reserve, tokenB_reserve))
+            neighbours[tokenB].append((market, tokenA, tokenB_reserve, tokenA_reserve))
+
+        # price in WETH (raw units) and liquidity of the weakest hop on the route
+        prices = {WETH: 1.0}
+        widths = {WETH: float("inf")}
+        routes = {WETH: []}
+        queue = [(-widths[WETH], WETH)]
+
+        while queue:
+            width, token = heapq.heappop(queue)
+            if -width < widths[token]:
+                continue
+
+            for market, other, token_reserve, other_reserve in neighbours[token]:
+                liquidity = 2 * token_reserve * prices[token]
+                other_width = min(widths[token], liquidity)
+                if other_width > widths.get(other, 0):
+                    widths[other] = other_width
+                    prices[other] = token_reserve / other_reserve * prices[token]
+                    routes[other] = [(market, other, token)] + routes[token]
+                    heapq.heappush(queue, (-other_width, other))
+
+        return routes
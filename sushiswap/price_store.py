@@ -0,0 +1,57 @@
+import os
+import sqlite3
+import threading
+
+PRICE_DB = "cache/prices.sqlite"
+
+# Max number of SQL variables in a single statement
+CHUNK_SIZE = 900
+
+class PriceStore:
+    """Token prices in USD by block, stored in SQLite.
+    Shared by all pools and runs, so every (token, block) price is fetched from the subgraph only once.
+    """
+
+    def __init__(self, path=PRICE_DB):
+        self._path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def getPrices(self, token, blocks):
+        """Return dict of stored prices of token, where key is block. Blocks without stored price are left out."""
+
+        blocks = list(blocks)
+        prices = {}
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(blocks), CHUNK_SIZE):
+                chunk = blocks[i:i+CHUNK_SIZE]
+                rows = connection.execute(
+                    "SELECT block, price FROM prices WHERE token = ? AND block IN ({0})".format(",".join("?" * len(chunk))),
+                    [token] + chunk)
+                for block, price in rows:
+                    prices[block] = price
+        return prices
+
+    def putPrices(self, token, prices):
+        """Store prices of token, given as dict where key is block."""
+
+        rows = [(token, block, price) for block, price in prices.items() if price is not None]
+        if not rows:
+            return
+
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO prices (token, block, price) VALUES (?, ?, ?)", rows)
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS prices (token TEXT, block INTEGER, price REAL, PRIMARY KEY (token, block)) WITHOUT ROWID")
+        return self._connection
+
+
+price_store = PriceStore()
@@ -1,5 +1,8 @@
 #%%
 # Make name mappings
+import os
+from token_store import TokenStore, TOKEN_DB
+
 pairs = {}
 pairs["0xc3d03e4f041fd4cd388c549ee2a29a9e5075882f"] = "DAI_WETH"
 pairs["0xc558f600b34a5f69dd2f0d06cb8a88d829b7420a"] = "LDO_WETH"
@@ -35,8 +38,14 @@ pairs["0xa1d7b2d891e3a1f9ef4bbc5be20630c2feb1c470"] = "SNX_WETH"
 pairs["0xba13afecda9beb75de5c56bbaf696b880a5a50dd"] = "MKR_WETH"
 pairs["0xdafd66636e2561b0284edde37e42d192f2844d40"] = "UNI_WETH"
 
+# markets collected by data_collector which aren't named above, if its token store exists
+if os.path.isfile(TOKEN_DB):
+    for market, name in TokenStore().getMarketNames().items():
+        pairs.setdefault(market, name)
+
 # Load position data
 import pandas as pd
+from stats_dataset import load_stats
 
 DATASET_NAME = "top20-volume"
 
@@ -44,7 +53,8 @@ FOLDER = "top20-volume-stats/"
 FILE_NAME = FOLDER + "top20-volume-combined.csv"
 PLOTS = FOLDER + "plots/"
 
-df = pd.read_csv(FILE_NAME, parse_dates=["position_end_date", "position_start_date"])
+# Parquet dataset of the folder is memory mapped if it exists, otherwise combined CSV is parsed
+df = load_stats(FOLDER, FILE_NAME)
 
 df.head(10)
 
@@ -107,7 +117,7 @@ ax = pool_vs_hodl_mean.plot.bar(figsize=(10,7), rot=90)
 ax.set_title('Average ROI vs HODL per pool, including rewards', fontweight='bold', color= 'yellow');
 ax.tick_params(colors='yellow', which='both')
 
-pool_vs_hodl_labels = [pairs[pair_address.get_text()] for pair_address in ax.get_xticklabels()]
+pool_vs_hodl_labels = [pairs.get(pair_address.get_text(), pair_address.get_text()) for pair_address in ax.get_xticklabels()]
 ax.set_xticklabels(pool_vs_hodl_labels, rotation=40, ha='right')
 ax.figure.savefig(PLOTS + DATASET_NAME + "-barchart_avg_roi_by_pool")
 ax
@@ -121,7 +131,7 @@ ax = net_gains_mean.plot.bar(rot=90)
 ax.set_title('Average net gain per pool', fontweight='bold', color= 'yellow');
 ax.tick_params(colors='yellow', which='both')
 
-net_gain_labels = [pairs[pair_address.get_text()] for pair_address in ax.get_xticklabels()]
+net_gain_labels = [pairs.get(pair_address.get_text(), pair_address.get_text()) for pair_address in ax.get_xticklabels()]
 ax.set_xticklabels(net_gain_labels, rotation=60, ha='right')
 ax
 
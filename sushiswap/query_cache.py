@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from metrics import metrics, CACHE_HITS, CACHE_MISSES
+from query_registry import query_registry
+
+CACHE_DIR = "cache/queries/"
+CACHE_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_SIZE = 20 * 1024 * 1024 * 1024
+REPLAY_ONLY = False
+
+# Variables which pin a query to a point in chain history. Responses for such queries never change,
+# so they are kept regardless of TTL.
+BLOCK_VARIABLES = ["block", "blocks", "toBlock"]
+
+
+class CacheMissError(Exception):
+    """Raised in replay only mode when a query response is not in the cache."""
+
+
+class QueryCache:
+    """Content-addressed disk cache of subgraph responses.
+    Key is the hash of query text, endpoint and query variables (including the block for time-travel queries),
+    so responses of a query file are never served after its fields change.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=None, max_size=None, replay_only=False):
+        """ttl - seconds after which non historical responses expire, None to never expire
+        max_size - max size of the cache directory in bytes, oldest entries are evicted first
+        replay_only - never go to the network, raise CacheMissError for queries not in the cache
+        """
+        self._directory = directory
+        self._ttl = ttl
+        self._max_size = max_size
+        self._replay_only = replay_only
+        self._size = None
+
+    def key(self, endpoint, filename, variables, block=None):
+        payload = {
+            "endpoint": endpoint,
+            "query": os.path.basename(filename),
+            # documents built at runtime have the hash of their text in variables
+            "document": query_registry.digest(filename),
+            "variables": variables,
+            "block": block if block is not None else self._pinnedBlock(variables),
+        }
+        serialized = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(serialized.encode()).hexdigest()
+
+    def get(self, key):
+        """Return cached response or None if there is no valid entry for the key."""
+
+        entry = self._entry(key)
+        return entry["response"] if entry is not None else None
+
+    def _entry(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        expired = self._ttl is not None and not entry["pinned"] and time.time() - entry["created"] > self._ttl
+        if expired and not self._replay_only:
+            self._remove(path)
+            return None
+
+        # touch the file so eviction drops least recently used entries first
+        os.utime(path)
+        return entry
+
+    def put(self, key, variables, response, block=None, size=None):
+        """size - bytes the response was received in, kept with it"""
+
+        if self._replay_only:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        current_size = self._currentSize() if self._max_size is not None else None
+
+        entry = {
+            "created": time.time(),
+            "pinned": block is not None or self._pinnedBlock(variables) is not None,
+            "response": response,
+            "bytes": size,
+        }
+
+        # write to temp file first so a crash never leaves half written entry behind,
+        # temp file is unique to the process and thread as the cache can be shared by parallel workers
+        tmp_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+        if self._max_size is not None:
+            self._size = current_size + os.path.getsize(path)
+            if self._size > self._max_size:
+                self._evict()
+
+    def fetch(self, endpoint, filename, variables, execute, block=None):
+        """Return response from the cache, or call execute() and store its response.
+        block pins the response to a point in chain history for queries without block variables.
+        """
+
+        key = self.key(endpoint, filename, variables, block)
+        response = self.get(key)
+        self._record(filename, response)
+        if response is not None:
+            return response
+
+        if self._replay_only:
+            raise CacheMissError("No cached response for {0} with {1}".format(filename, variables))
+
+        response = execute()
+        self.put(key, variables, response, block)
+        return response
+
+    async def fetchAsync(self, endpoint, filename, variables, execute, size=None):
+        """Same as fetch, for use inside event loop. execute is a coroutine function.
+        size - ResponseSize execute fills in, set to the bytes of the cached response when served from the cache
+        """
+
+        key = self.key(endpoint, filename, variables)
+        entry = self._entry(key)
+        self._record(filename, entry)
+        if entry is not None:
+            if size is not None:
+                size.bytes = entry.get("bytes")
+            return entry["response"]
+
+        if self._replay_only:
+            raise CacheMissError("No cached response for {0} with {1}".format(filename, variables))
+
+        response = await execute()
+        self.put(key, variables, response, size=size.bytes if size is not None else None)
+        return response
+
+    def _record(self, filename, response):
+        metrics.increment(CACHE_HITS if response is not None else CACHE_MISSES, query=os.path.basename(filename))
+
+    def isReplayOnly(self):
+        return self._replay_only
+
+    def _pinnedBlock(self, variables):
+        for name in BLOCK_VARIABLES:
+            if variables.get(name) is not None:
+                return variables[name]
+        return None
+
+    def _path(self, key):
+        # shard by first 2 chars of the key to keep directories small
+        return os.path.join(self._directory, key[:2], key + ".json")
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self._directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # removed by another worker
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _currentSize(self):
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        return self._size
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits into max_size."""
+
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+
+        target = self._max_size * 0.9
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            self._remove(path)
+            self._size -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+# Shared by all subgraph clients, nothing is read from disk until the first query
+default_cache = QueryCache(CACHE_DIR, CACHE_TTL, CACHE_MAX_SIZE, REPLAY_ONLY)
+
+# For queries which have to be fresh on every run (ie. latest indexed block), responses are kept only for replay
+live_cache = QueryCache(CACHE_DIR, 0, CACHE_MAX_SIZE, REPLAY_ONLY)
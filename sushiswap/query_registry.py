@@ -0,0 +1,109 @@
+import glob
+import hashlib
+import json
+import os
+import re
+
+from gql import gql
+from graphql import build_client_schema, get_introspection_query, validate
+
+QUERIES_DIR = "queries/"
+SCHEMA_DIR = "cache/schemas/"
+
+DEPLOYMENT_QUERY = gql("query { _meta { deployment } }")
+INTROSPECTION_QUERY = gql(get_introspection_query())
+
+
+class QueryRegistry:
+    """Parsed documents of all the queries in queries/ folder.
+    Every file is read and parsed once, on first use, and then shared by all the clients.
+    """
+
+    def __init__(self, directory=QUERIES_DIR):
+        self._directory = directory
+        self._queries = None
+        self._digests = None
+
+    def get(self, filename):
+        """Return parsed query document for file, ie. 'queries/get_all_markets.graphql'."""
+        return self._load()[os.path.basename(filename)]
+
+    def digest(self, filename):
+        """Return hash of the text of query file, None for names which aren't query files (ie. documents built at runtime)."""
+
+        self._load()
+        return self._digests.get(os.path.basename(filename))
+
+    def validate(self, schema):
+        """Validate all queries against schema.
+        Return dict where key is query file name and value list of validation errors, for invalid queries only.
+        """
+
+        errors = {}
+        for name, document in self._load().items():
+            query_errors = validate(schema, document)
+            if query_errors:
+                errors[name] = [error.message for error in query_errors]
+        return errors
+
+    def _load(self):
+        if self._queries is None:
+            queries = {}
+            digests = {}
+            for path in sorted(glob.glob(os.path.join(self._directory, "*.graphql"))):
+                with open(path) as f:
+                    text = f.read()
+                queries[os.path.basename(path)] = gql(text)
+                digests[os.path.basename(path)] = hashlib.sha256(text.encode()).hexdigest()[:16]
+            self._digests = digests
+            self._queries = queries
+        return self._queries
+
+
+class SchemaSnapshots:
+    """Subgraph schemas stored on disk, one file per subgraph deployment.
+    Schema is introspected only when a new version of the subgraph is deployed.
+    """
+
+    def __init__(self, directory=SCHEMA_DIR):
+        self._directory = directory
+
+    def load(self, endpoint, execute, offline=False):
+        """Return schema of the subgraph behind endpoint.
+        execute is used to run the version and introspection queries, offline mode uses the latest snapshot on disk.
+        Return None if schema isn't available.
+        """
+
+        folder = os.path.join(self._directory, re.sub(r"[^A-Za-z0-9]+", "_", endpoint))
+
+        if offline:
+            path = self._latestSnapshot(folder)
+        else:
+            deployment = execute(DEPLOYMENT_QUERY)["_meta"]["deployment"]
+            path = os.path.join(folder, deployment + ".json")
+            if not os.path.isfile(path):
+                print("Fetching schema of {0} for deployment {1}".format(endpoint, deployment))
+                introspection = execute(INTROSPECTION_QUERY)
+                os.makedirs(folder, exist_ok=True)
+                tmp_path = "{0}.{1}.tmp".format(path, os.getpid())
+                with open(tmp_path, "w") as f:
+                    json.dump(introspection, f)
+                os.replace(tmp_path, path)
+
+        if path is None:
+            return None
+
+        with open(path) as f:
+            return build_client_schema(json.load(f))
+
+    def _latestSnapshot(self, folder):
+        if not os.path.isdir(folder):
+            return None
+        snapshots = [os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".json")]
+        if not snapshots:
+            return None
+        return max(snapshots, key=os.path.getmtime)
+
+
+query_registry = QueryRegistry()
+schema_snapshots = SchemaSnapshots()
@@ -0,0 +1,263 @@
+import asyncio
+import json
+import threading
+
+import numpy as np
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+
+PAGE_SIZE = 1000
+
+# Number of markets packed into one batched snapshots request, adapted to response size between 1 and MAX_BATCH_SIZE
+BATCH_SIZE = 8
+MAX_BATCH_SIZE = 64
+MAX_RESPONSE_BYTES = 8 * 1024 * 1024
+# Errors of requests which were too large for the subgraph, batch is retried at half the size
+BATCH_ERRORS = (TransportQueryError, TransportServerError, asyncio.TimeoutError)
+
+SNAPSHOT_FIELDS = "id inputTokenBalances blockNumber"
+
+class SnapshotIndex:
+    """Snapshots of a single market sorted by block number.
+    Snapshots are fetched by contiguous block ranges, after which "latest snapshot at or before block"
+    is answered locally for any block within the covered range.
+    """
+
+    def __init__(self, graph_client, market):
+        self._client = graph_client
+        self._market = market
+        self._blocks = np.empty(0, dtype=np.int64)
+        self._snapshots = []
+        # covered block range, inclusive
+        self._from_block = None
+        self._to_block = None
+        self._lock = threading.Lock()
+
+    def lookup(self, blocks):
+        """Return dict where key is block and value is the latest snapshot at or before that block.
+        Value is None for blocks before the first snapshot of the market.
+        """
+
+        blocks = sorted(set(blocks))
+        if not blocks:
+            return {}
+
+        with self._lock:
+            self._ensureRange(blocks[0], blocks[-1])
+            positions = np.searchsorted(self._blocks, blocks, side='right') - 1
+            # _add replaces the list, positions are only valid for the one they were searched in
+            snapshots = self._snapshots
+
+        return {block: (snapshots[position] if position >= 0 else None) for block, position in zip(blocks, positions.tolist())}
+
+    def _ensureRange(self, from_block, to_block):
+        for range_from, range_to, needs_before in self._missingRanges(from_block, to_block):
+            snapshots = self._fetchSnapshotBefore(range_from) if needs_before else []
+            self._add(snapshots + self._fetchRange(range_from, range_to))
+            self._cover(range_from, range_to)
+
+    def _missingRanges(self, from_block, to_block):
+        """Return list of (from block, to block, needs snapshot before) for parts of the range which are not covered yet.
+        Range in front of the covered one needs the latest snapshot before it, so lookups at its start have a value.
+        """
+
+        if self._from_block is None:
+            return [(from_block, to_block, True)]
+
+        ranges = []
+        if from_block < self._from_block:
+            ranges.append((from_block, self._from_block - 1, True))
+        if to_block > self._to_block:
+            ranges.append((self._to_block + 1, to_block, False))
+        return ranges
+
+    def _cover(self, from_block, to_block):
+        """Extend covered range by a fetched range adjacent to it."""
+
+        if self._from_block is None:
+            self._from_block, self._to_block = from_block, to_block
+        else:
+            self._from_block = min(self._from_block, from_block)
+            self._to_block = max(self._to_block, to_block)
+
+    def _fetchRange(self, from_block, to_block):
+        """Fetch all snapshots between from_block and to_block, paginating by block number."""
+
+        snapshots = []
+        seen_ids = set()
+        cursor = from_block
+
+        while True:
+            vars = {"market": self._market, "fromBlock": cursor, "toBlock": to_block}
+            response = self._client.runQuery('queries/market_snapshots_range.graphql', vars)
+            page = response["marketSnapshots"]
+
+            # next page starts at the last block of this one, as there can be more snapshots within the same block
+            for snapshot in page:
+                if snapshot["id"] not in seen_ids:
+                    seen_ids.add(snapshot["id"])
+                    snapshots.append(snapshot)
+
+            if len(page) < PAGE_SIZE:
+                break
+
+            next_cursor = int(page[-1]["blockNumber"])
+            cursor = next_cursor if next_cursor > cursor else cursor + 1
+
+        return snapshots
+
+    def _fetchSnapshotBefore(self, block):
+        """Fetch the latest snapshot before block, so lookups at the start of a range have a value."""
+
+        vars = {"market": self._market, "toBlock": block - 1}
+        response = self._client.runQuery('queries/market_snapshot_before_block.graphql', vars)
+        return response["marketSnapshots"]
+
+    def _add(self, snapshots):
+        """Merge snapshots into the index, keeping only the last snapshot of every block."""
+
+        by_block = dict(zip(self._blocks.tolist(), self._snapshots))
+        for snapshot in snapshots:
+            by_block[int(snapshot["blockNumber"])] = snapshot
+
+        blocks = sorted(by_block.keys())
+        self._blocks = np.array(blocks, dtype=np.int64)
+        self._snapshots = [by_block[block] for block in blocks]
+
+
+# Snapshots kept in the indexes of all markets when evict_indexes is called, ie. between batches of a long run
+MAX_INDEXED_SNAPSHOTS = 500000
+
+# Indexes shared by all price providers, by market, the most recently used last
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_snapshot_index(graph_client, market):
+    with _indexes_lock:
+        index = _indexes.pop(market, None)
+        if index is None:
+            index = SnapshotIndex(graph_client, market)
+        _indexes[market] = index
+        return index
+
+def evict_indexes(max_snapshots=MAX_INDEXED_SNAPSHOTS):
+    """Drop the least recently used indexes until all the indexes hold at most max_snapshots snapshots.
+    Dropped markets are fetched again when they are looked up next time.
+    """
+
+    with _indexes_lock:
+        total = sum(len(index._snapshots) for index in _indexes.values())
+        for market in list(_indexes):
+            if total <= max_snapshots:
+                break
+            total -= len(_indexes.pop(market)._snapshots)
+
+
+class _RangeFetch:
+    """Snapshots of one market's block range, fetched page by page as a part of batched requests."""
+
+    def __init__(self, index, from_block, to_block, needs_before):
+        self.index = index
+        self.from_block = from_block
+        self.to_block = to_block
+        self.needs_before = needs_before
+        self.cursor = from_block
+        self.snapshots = []
+        self.seen_ids = set()
+        self.done = False
+
+    def subQueries(self, i):
+        """Return variable definitions, aliased sub-queries and variables of the next page, with alias suffix i."""
+
+        definitions = ["$m{0}: String!, $f{0}: BigInt!, $t{0}: BigInt!".format(i)]
+        fields = ["r{0}: marketSnapshots(first: {1}, where: {{market: $m{0}, blockNumber_gte: $f{0}, blockNumber_lte: $t{0}}}, "
+                  "orderBy: blockNumber, orderDirection: asc) {{ {2} }}".format(i, PAGE_SIZE, SNAPSHOT_FIELDS)]
+        vars = {"m%d" % i: self.index._market, "f%d" % i: self.cursor, "t%d" % i: self.to_block}
+
+        if self.needs_before:
+            definitions.append("$b{0}: BigInt!".format(i))
+            fields.append("b{0}: marketSnapshots(first: 1, where: {{market: $m{0}, blockNumber_lte: $b{0}}}, "
+                          "orderBy: blockNumber, orderDirection: desc) {{ {1} }}".format(i, SNAPSHOT_FIELDS))
+            vars["b%d" % i] = self.from_block - 1
+
+        return definitions, fields, vars
+
+    def addPage(self, response, i):
+        """Add page of the response to fetched snapshots. Once the range is complete, snapshots are added to the index."""
+
+        if self.needs_before:
+            self.snapshots.extend(response["b%d" % i])
+            self.needs_before = False
+
+        page = response["r%d" % i]
+        for snapshot in page:
+            if snapshot["id"] not in self.seen_ids:
+                self.seen_ids.add(snapshot["id"])
+                self.snapshots.append(snapshot)
+
+        if len(page) < PAGE_SIZE:
+            with self.index._lock:
+                self.index._add(self.snapshots)
+                self.index._cover(self.from_block, self.to_block)
+            self.done = True
+            return
+
+        # same paging as SnapshotIndex._fetchRange
+        next_cursor = int(page[-1]["blockNumber"])
+        self.cursor = next_cursor if next_cursor > self.cursor else self.cursor + 1
+
+
+def prefetch_snapshots(graph_client, ranges):
+    """Fetch snapshots of many markets into their shared indexes, so that later lookups are answered locally.
+    ranges - dict where key is market and value (from block, to block)
+    Snapshot queries of several markets are packed into one request as aliased sub-queries. Number of markets per request
+    starts at BATCH_SIZE, is halved when the response is over MAX_RESPONSE_BYTES or the subgraph rejects the request,
+    and doubled while responses stay well below the limit.
+    """
+
+    pending = []
+    for market, (from_block, to_block) in ranges.items():
+        index = get_snapshot_index(graph_client, market)
+        with index._lock:
+            missing_ranges = index._missingRanges(from_block, to_block)
+        pending.extend(_RangeFetch(index, *missing_range) for missing_range in missing_ranges)
+
+    if not pending:
+        return
+
+    print("Collect snapshots of", len(ranges), "markets...")
+
+    batch_size = BATCH_SIZE
+    requests = 0
+    while pending:
+        batch = pending[:batch_size]
+
+        definitions, fields, vars = [], [], {}
+        for i, fetch in enumerate(batch):
+            fetch_definitions, fetch_fields, fetch_vars = fetch.subQueries(i)
+            definitions.extend(fetch_definitions)
+            fields.extend(fetch_fields)
+            vars.update(fetch_vars)
+        text = "query ({0}) {{\n  {1}\n}}".format(", ".join(definitions), "\n  ".join(fields))
+
+        try:
+            # all the sub-queries end at fixed blocks, so the response never changes
+            response = graph_client.runDocument('market_snapshots_batch', text, vars, max(fetch.to_block for fetch in batch))
+        except BATCH_ERRORS:
+            if batch_size == 1:
+                raise
+            batch_size = max(1, len(batch) // 2)
+            continue
+        requests += 1
+
+        for i, fetch in enumerate(batch):
+            fetch.addPage(response, i)
+        # unfinished ranges continue with their next page in the next request
+        pending = [fetch for fetch in batch if not fetch.done] + pending[len(batch):]
+
+        response_size = len(json.dumps(response))
+        if response_size > MAX_RESPONSE_BYTES:
+            batch_size = max(1, len(batch) // 2)
+        elif response_size < MAX_RESPONSE_BYTES // 4 and len(batch) == batch_size:
+            batch_size = min(MAX_BATCH_SIZE, batch_size * 2)
+
+    print("Collected snapshots of", len(ranges), "markets in", requests, "requests")
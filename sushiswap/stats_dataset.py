@@ -0,0 +1,162 @@
+import glob
+import os
+import shutil
+import uuid
+from datetime import date
+
+import pandas as pd
+
+# pyarrow is needed only for the Parquet output, CSV stats work without it
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+PARQUET_FOLDER = "parquet/"
+# Rows buffered by StatsWriter before they are written, so streamed stats don't end up in many tiny files
+BUFFER_ROWS = 20000
+DATE_COLUMNS = ["position_start_date", "position_end_date"]
+
+# Columns of position stats and their types, in the same order as in CSV files
+ADDRESS = "address"
+BLOCK = "block"
+DATE = "date"
+VALUE = "value"
+COUNT = "count"
+STATS_COLUMNS = {
+    'market': ADDRESS,
+    'account': ADDRESS,
+    'position_start_block': BLOCK,
+    'position_end_block': BLOCK,
+    'position_start_date': DATE,
+    'position_end_date': DATE,
+    'tokenA': ADDRESS,
+    'tokenB': ADDRESS,
+    'position_investment_value': VALUE,
+    'position_redemption_value': VALUE,
+    'position_redemption_value_if_held': VALUE,
+    'pool_net_gain': VALUE,
+    'hodl_net_gain': VALUE,
+    'pool_roi': VALUE,
+    'hodl_roi': VALUE,
+    'pool_vs_hodl_roi': VALUE,
+    'claimed_rewards_in_USD': VALUE,
+    'position_trade_counter': COUNT,
+}
+
+
+def is_available():
+    return pa is not None
+
+
+def dataset_folder(filename):
+    """Return folder of the Parquet dataset for stats CSV file, shared by all the CSV files in the same folder."""
+    return os.path.join(os.path.dirname(filename), PARQUET_FOLDER)
+
+
+def write_stats(stats, folder, append=False):
+    """Write position stats (dict of stats by position ID) to Parquet dataset in folder, partitioned by market.
+    Every call adds a new file to the partitions of its markets. Unless append is set, existing data of those markets is replaced.
+    """
+
+    by_market = {}
+    for position_stats in stats.values():
+        market = position_stats['market']
+        if market not in by_market: by_market[market] = []
+        by_market[market].append(position_stats)
+
+    for market, rows in by_market.items():
+        partition = os.path.join(folder, "market=" + market)
+        if not append and os.path.isdir(partition):
+            shutil.rmtree(partition)
+        os.makedirs(partition, exist_ok=True)
+
+        path = os.path.join(partition, "part-{0}.parquet".format(uuid.uuid4().hex))
+        pq.write_table(_toTable(rows), path + ".tmp", compression="zstd")
+        os.replace(path + ".tmp", path)
+
+
+class StatsWriter:
+    """Parquet dataset written part by part while stats are being computed.
+    Existing data of a market is replaced when the first rows of the market are written, later rows are appended.
+    """
+
+    def __init__(self, folder, buffer_rows=BUFFER_ROWS):
+        self._folder = folder
+        self._buffer_rows = buffer_rows
+        self._rows = []
+        self._markets = set()
+
+    def write(self, stats):
+        """Add position stats (dict of stats by position ID), writing buffered rows once there are enough of them."""
+
+        self._rows.extend(stats.values())
+        if len(self._rows) >= self._buffer_rows:
+            self.flush()
+
+    def flush(self):
+        new_markets = {}
+        seen_markets = {}
+        for row in self._rows:
+            rows = seen_markets if row['market'] in self._markets else new_markets
+            rows[len(rows)] = row
+
+        write_stats(new_markets, self._folder)
+        write_stats(seen_markets, self._folder, append=True)
+        self._markets.update(row['market'] for row in new_markets.values())
+        self._rows = []
+
+
+def write_stats_from_csv(filename, folder):
+    """Convert existing stats CSV file into Parquet dataset in folder."""
+
+    df = pd.read_csv(filename, dtype={'market': str, 'account': str, 'tokenA': str, 'tokenB': str})
+    write_stats(dict(enumerate(df.to_dict('records'))), folder)
+
+
+def load_stats(folder, csv_filename=None):
+    """Load position stats of all the markets in folder into DataFrame.
+    Parquet dataset is memory mapped; without it (or without pyarrow) stats are read from csv_filename.
+    Dates are loaded as datetime64 and addresses as categoricals.
+    """
+
+    parquet_folder = os.path.join(folder, PARQUET_FOLDER)
+    if is_available() and glob.glob(os.path.join(parquet_folder, "market=*", "*.parquet")):
+        partitioning = ds.HivePartitioning.discover(infer_dictionary=True)
+        table = pq.read_table(parquet_folder, partitioning=partitioning, memory_map=True)
+        return table.to_pandas(date_as_object=False)[list(STATS_COLUMNS)]
+
+    if csv_filename is None:
+        raise FileNotFoundError("No stats in {0}".format(folder))
+    return pd.read_csv(csv_filename, parse_dates=DATE_COLUMNS)
+
+
+def _schema():
+    types = {
+        ADDRESS: pa.dictionary(pa.int32(), pa.string()),
+        BLOCK: pa.int64(),
+        DATE: pa.date32(),
+        VALUE: pa.float64(),
+        COUNT: pa.int64(),
+    }
+    # market is stored in the partition path
+    return pa.schema([(name, types[column_type]) for name, column_type in STATS_COLUMNS.items() if name != 'market'])
+
+
+def _toTable(rows):
+    converters = {
+        ADDRESS: str,
+        BLOCK: int,
+        DATE: lambda value: value if isinstance(value, date) else date.fromisoformat(value),
+        VALUE: float,
+        COUNT: int,
+    }
+
+    schema = _schema()
+    columns = {}
+    for name in schema.names:
+        convert = converters[STATS_COLUMNS[name]]
+        columns[name] = [convert(row[name]) for row in rows]
+    return pa.Table.from_pydict(columns, schema=schema)
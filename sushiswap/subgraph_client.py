@@ -0,0 +1,120 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+from gql import gql
+
+from connection_pool import connection_pool
+from query_cache import default_cache, live_cache
+from query_registry import query_registry, schema_snapshots
+from transport import transport
+
+# Query validation errors by endpoint, schema of every endpoint is loaded once per process
+_query_errors = {}
+_schema_lock = threading.Lock()
+
+class GraphClient:
+    """Base class of subgraph clients.
+    Clients don't hold connections themselves, all the queries go through the shared connection pool.
+    """
+
+    def __init__(self, endpoint, cache=None, pool=None):
+        self._subgraph_endpoint = endpoint
+        self._cache = cache if cache is not None else default_cache
+        self._pool = pool if pool is not None else connection_pool
+
+    def loadSchema(self):
+        """Load schema of the subgraph and validate all the queries against it.
+        Schema is introspected only for a new subgraph deployment, otherwise snapshot on disk is used.
+        """
+
+        with _schema_lock:
+            if self._subgraph_endpoint in _query_errors:
+                return
+
+            execute = lambda document: self._pool.run(self._executeDocument(document, None, "schema"))
+            schema = schema_snapshots.load(self._subgraph_endpoint, execute, self._cache.isReplayOnly())
+
+            errors = query_registry.validate(schema) if schema is not None else {}
+            for name in errors:
+                print("Query {0} doesn't match schema of {1}".format(name, self._subgraph_endpoint))
+            _query_errors[self._subgraph_endpoint] = errors
+
+    def runQuery(self, filename, args):
+        """Run query from file with given variables.
+        Response is served from the disk cache if the same query has been run before.
+        """
+        return self._cache.fetch(self._subgraph_endpoint, filename, args, lambda: self._execute(filename, args))
+
+    def runDocument(self, name, text, args, block=None):
+        """Run query built at runtime (ie. batched query with aliases) with given variables.
+        Response is cached by name and hash of the query text; block marks queries of historical data, which never expire.
+        """
+
+        key_args = dict(args, document=hashlib.sha256(text.encode()).hexdigest()[:16])
+
+        def execute():
+            self.loadSchema()
+            return self._pool.run(self._executeDocument(gql(text), args, name))
+
+        return self._cache.fetch(self._subgraph_endpoint, name, key_args, execute, block)
+
+    def getHeadBlock(self):
+        """Return number of the latest block indexed by the subgraph.
+        Response is never served from the cache, except in replay only mode.
+        """
+
+        filename = 'queries/get_head_block.graphql'
+        response = live_cache.fetch(self._subgraph_endpoint, filename, {}, lambda: self._execute(filename, {}))
+        return response["_meta"]["block"]["number"]
+
+    def runAsync(self, coroutine):
+        """Run coroutine (ie. a number of runQueryAsync calls) on the connection pool's event loop."""
+        return self._pool.run(coroutine)
+
+    async def runQueryAsync(self, filename, args, size=None):
+        """Async version of runQuery, has to be awaited within runAsync.
+        size - ResponseSize to hold the bytes of the response, also when it's served from the cache
+        """
+
+        async def execute():
+            if self._subgraph_endpoint not in _query_errors:
+                await asyncio.to_thread(self.loadSchema)
+            return await self._executeDocument(self._query(filename), args, os.path.basename(filename), size)
+
+        return await self._cache.fetchAsync(self._subgraph_endpoint, filename, args, execute, size)
+
+    def cachedPageSize(self, filename, args):
+        """Return page size the page of a scan at cursor args was cached with, None if it isn't cached.
+        Page sizes of scans adapt to responses, a re-run requests every page with the recorded size to hit the cache.
+        """
+        return self._cache.get(self._pageSizeKey(filename, args))
+
+    def cachePageSize(self, filename, args, size):
+        self._cache.put(self._pageSizeKey(filename, args), args, size)
+
+    def _pageSizeKey(self, filename, args):
+        return self._cache.key(self._subgraph_endpoint, filename, dict(args, page_size_of_cursor=True))
+
+    async def _executeDocument(self, document, args, query=None, size=None):
+        """Execute document on the pool's session, retrying failed requests and keeping to the endpoint's rate limit.
+        query - name of the query in metrics
+        size - ResponseSize to hold the bytes of the response
+        """
+
+        async def request(size):
+            session = await self._pool.session(self._subgraph_endpoint)
+            return await session.execute(document, variable_values=args, extra_args={"trace_request_ctx": size})
+
+        return await transport.execute(self._subgraph_endpoint, request, query, size)
+
+    def _query(self, filename):
+        errors = _query_errors[self._subgraph_endpoint].get(os.path.basename(filename))
+        if errors:
+            raise ValueError("Query {0} is not valid for {1}: {2}".format(filename, self._subgraph_endpoint, errors))
+        return query_registry.get(filename)
+
+    def _execute(self, filename, args):
+        self.loadSchema()
+        return self._pool.run(self._executeDocument(self._query(filename), args, os.path.basename(filename)))
@@ -0,0 +1,420 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import random
+import time
+
+import aiohttp
+from aiohttp import web
+from graphql import build_schema, graphql
+
+import synthetic_data
+
+# Subgraphs served by the stand-in, at the same paths as on the hosted service
+SUBGRAPHS = ["sushiswap", "sushiswap-farms"]
+PATH_PREFIX = "/subgraphs/name/simplefi-finance/"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+DEPLOYMENT = "local-stand-in"
+
+# Page size when a query doesn't set `first`, same as graph-node
+DEFAULT_FIRST = 100
+# Fields compared as numbers in filters and ordering
+NUMERIC_FIELDS = {"blockNumber", "timestamp", "decimals"}
+
+# Part of the SimpleFi subgraph schemas used by the queries in queries/
+SCHEMA = build_schema("""
+scalar BigInt
+
+enum OrderDirection { asc desc }
+enum Position_orderBy { id blockNumber }
+enum Market_orderBy { id blockNumber }
+enum MarketSnapshot_orderBy { id blockNumber }
+enum Token_orderBy { id }
+
+input Block_height { number: Int }
+
+input Position_filter {
+  id: ID, id_gt: ID, id_lt: ID, id_in: [ID!]
+  market: String, closed: Boolean
+  blockNumber: BigInt, blockNumber_gt: BigInt, blockNumber_gte: BigInt, blockNumber_lt: BigInt, blockNumber_lte: BigInt, blockNumber_in: [BigInt!]
+}
+
+input Market_filter {
+  id: ID, id_gt: ID, id_lt: ID, id_in: [ID!]
+  inputTokens: [String!], inputTokens_contains: [String!]
+}
+
+input MarketSnapshot_filter {
+  id: ID, id_gt: ID, id_lt: ID, id_in: [ID!]
+  market: String
+  blockNumber: BigInt, blockNumber_gt: BigInt, blockNumber_gte: BigInt, blockNumber_lt: BigInt, blockNumber_lte: BigInt, blockNumber_in: [BigInt!]
+}
+
+input Token_filter { id: ID, id_gt: ID, id_lt: ID, id_in: [ID!] }
+
+type Transaction {
+  id: ID!
+  blockNumber: BigInt!
+  timestamp: BigInt!
+  inputTokenAmounts: [String!]!
+  rewardTokenAmounts: [String!]
+  transactionType: String!
+  transferredTo: String
+  transferredFrom: String
+  transactionHash: String!
+}
+
+type PositionSnapshot { transaction: Transaction! }
+
+type Position {
+  id: ID!
+  accountAddress: String!
+  closed: Boolean!
+  blockNumber: BigInt!
+  history: [PositionSnapshot!]!
+}
+
+type Token { id: ID!, name: String, symbol: String, decimals: Int }
+
+type Market {
+  id: ID!
+  inputTokens: [Token!]!
+  inputTokenTotalBalances: [String!]!
+  blockNumber: BigInt!
+}
+
+type MarketSnapshot { id: ID!, inputTokenBalances: [String!]!, blockNumber: BigInt! }
+
+type _Block_ { number: Int! }
+type _Meta_ { block: _Block_!, deployment: String! }
+
+type Query {
+  positions(first: Int, skip: Int, where: Position_filter, orderBy: Position_orderBy, orderDirection: OrderDirection, block: Block_height): [Position!]!
+  markets(first: Int, skip: Int, where: Market_filter, orderBy: Market_orderBy, orderDirection: OrderDirection, block: Block_height): [Market!]!
+  market(id: ID!, block: Block_height): Market
+  marketSnapshots(first: Int, skip: Int, where: MarketSnapshot_filter, orderBy: MarketSnapshot_orderBy, orderDirection: OrderDirection, block: Block_height): [MarketSnapshot!]!
+  tokens(first: Int, skip: Int, where: Token_filter, orderBy: Token_orderBy, orderDirection: OrderDirection, block: Block_height): [Token!]!
+  _meta(block: Block_height): _Meta_
+}
+""")
+
+
+class Fixtures:
+    """Entities of the subgraphs, as dict where key is subgraph name and value dict of entity lists by collection,
+    ie. {"sushiswap": {"positions": [...], "markets": [...], "marketSnapshots": [...], "tokens": [...]}}.
+    Positions and snapshots reference their market by ID in a "market" field.
+    """
+
+    def __init__(self, subgraphs=None):
+        self.subgraphs = subgraphs or {name: {} for name in SUBGRAPHS}
+
+    @classmethod
+    def fromSyntheticData(cls, data):
+        """Entities of both subgraphs for data made by synthetic_data.generate."""
+
+        def positions(rows, market_of):
+            return [dict(row, market=market_of(row["id"]), closed=True,
+                         blockNumber=row["history"][-1]["transaction"]["blockNumber"]) for row in rows]
+
+        def market(market_id, tokens, balances, block):
+            return {"id": market_id, "inputTokens": [{"id": token} for token in tokens], "inputTokenTotalBalances": balances, "blockNumber": block}
+
+        snapshots = [dict(snapshot, market=market_id) for market_id, rows in data.snapshots.items() for snapshot in rows]
+        markets = [
+            market(market_id, sorted(tokens), data.snapshots[market_id][-1]["inputTokenBalances"], data.snapshots[market_id][0]["blockNumber"])
+            for market_id, tokens in data.markets.items()]
+        tokens = [dict(metadata, id=token) for token, metadata in data.tokens.items()]
+
+        farm_markets = [market(farm_id, [pool], [], str(synthetic_data.FIRST_BLOCK)) for pool, farm_id in data.farms.items()]
+
+        return cls({
+            "sushiswap": {
+                "positions": positions(data.positions, lambda position_id: position_id.split("-")[1]),
+                "markets": markets,
+                "marketSnapshots": snapshots,
+                "tokens": tokens,
+            },
+            "sushiswap-farms": {
+                "positions": positions(data.farm_positions, lambda position_id: "-".join(position_id.split("-")[1:3])),
+                "markets": farm_markets,
+                "marketSnapshots": [],
+                "tokens": [],
+            },
+        })
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.subgraphs, f)
+        os.replace(path + ".tmp", path)
+
+
+class Recordings:
+    """Responses of the hosted subgraphs stored one file per request, by subgraph name, query text and variables."""
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def get(self, name, query, variables):
+        path = self._path(name, query, variables)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)["response"]
+
+    def put(self, name, query, variables, response):
+        path = self._path(name, query, variables)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"query": query, "variables": variables, "response": response}, f)
+        os.replace(path + ".tmp", path)
+
+    def _path(self, name, query, variables):
+        key = hashlib.sha256(json.dumps([query, variables], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self._directory, name, key + ".json")
+
+
+class Resolver:
+    """Root value of the schema for one subgraph, answering collection fields from fixture entities.
+    Time travel (`block` argument) sees entities whose blockNumber is at or before the block, and markets
+    get input token balances of their latest snapshot at the block.
+    """
+
+    def __init__(self, entities):
+        self._entities = {collection: sorted(rows, key=lambda row: row["id"]) for collection, rows in entities.items()}
+        # rows and their IDs by collection and market (None for all the rows), ordered by ID
+        self._index = {}
+        for collection, rows in self._entities.items():
+            by_market = {None: rows}
+            for row in rows:
+                if "market" in row:
+                    by_market.setdefault(row["market"], []).append(row)
+            self._index[collection] = {market: (market_rows, [row["id"] for row in market_rows]) for market, market_rows in by_market.items()}
+
+        self._snapshots_by_market = {}
+        for snapshot in self._entities.get("marketSnapshots", []):
+            self._snapshots_by_market.setdefault(snapshot["market"], []).append(snapshot)
+        for snapshots in self._snapshots_by_market.values():
+            snapshots.sort(key=lambda snapshot: int(snapshot["blockNumber"]))
+
+        blocks = [int(row["blockNumber"]) for rows in self._entities.values() for row in rows if "blockNumber" in row]
+        self._head_block = max(blocks) if blocks else 0
+
+    def positions(self, info, **args):
+        return self._collection("positions", args)
+
+    def markets(self, info, **args):
+        return [self._marketAt(market, args.get("block")) for market in self._collection("markets", args)]
+
+    def market(self, info, id, block=None):
+        markets = self._collection("markets", {"where": {"id": id}, "block": block})
+        return self._marketAt(markets[0], block) if markets else None
+
+    def marketSnapshots(self, info, **args):
+        return self._collection("marketSnapshots", args)
+
+    def tokens(self, info, **args):
+        return self._collection("tokens", args)
+
+    def _meta(self, info, block=None):
+        number = block["number"] if block and block.get("number") is not None else self._head_block
+        return {"block": {"number": number}, "deployment": DEPLOYMENT}
+
+    def _collection(self, collection, args):
+        where = args.get("where") or {}
+        block = (args.get("block") or {}).get("number")
+        skip = args.get("skip") or 0
+        first = args.get("first")
+        limit = skip + (first if first is not None else DEFAULT_FIRST)
+
+        def visible(row):
+            if block is not None and "blockNumber" in row and int(row["blockNumber"]) > block:
+                return False
+            return all(_matches(row, condition, value) for condition, value in where.items())
+
+        rows = (row for row in self._candidates(collection, where) if visible(row))
+
+        order_by = args.get("orderBy")
+        descending = args.get("orderDirection") == "desc"
+        if order_by is None and not descending:
+            # rows come ordered by ID, so scanning stops at the end of the page
+            rows = [row for _, row in zip(range(limit), rows)]
+        else:
+            rows = sorted(rows, key=lambda row: _sortValue(order_by or "id", row[order_by or "id"]), reverse=descending)
+        return rows[skip:limit]
+
+    def _candidates(self, collection, where):
+        """Rows of collection ordered by ID, narrowed down by market and ID bounds of the filter."""
+
+        index = self._index.get(collection, {})
+        market = where.get("market")
+        if market is not None and market not in index:
+            return []
+        rows, ids = index.get(market, ([], []))
+
+        start = bisect.bisect_right(ids, where["id_gt"]) if where.get("id_gt") is not None else 0
+        end = bisect.bisect_left(ids, where["id_lt"]) if where.get("id_lt") is not None else len(ids)
+        return rows[start:end]
+
+    def _marketAt(self, market, block):
+        if block is None or block.get("number") is None or market["id"] not in self._snapshots_by_market:
+            return market
+        snapshots = [snapshot for snapshot in self._snapshots_by_market[market["id"]] if int(snapshot["blockNumber"]) <= block["number"]]
+        if not snapshots:
+            return market
+        return dict(market, inputTokenTotalBalances=snapshots[-1]["inputTokenBalances"])
+
+
+def _sortValue(field, value):
+    return int(value) if field in NUMERIC_FIELDS else value
+
+
+def _matches(row, condition, value):
+    """Check graph-node style filter condition, ie. id_gt or blockNumber_in, against entity. None value matches everything."""
+
+    if value is None:
+        return True
+
+    field, _, operator = condition.partition("_")
+    actual = row.get(field)
+    if field == "inputTokens":
+        actual = [token["id"] for token in actual]
+        return set(value) <= set(actual) if operator == "contains" else actual == value
+
+    if field in NUMERIC_FIELDS:
+        actual = int(actual)
+        value = [int(v) for v in value] if isinstance(value, list) else int(value)
+
+    if operator == "":
+        return actual == value
+    if operator == "in":
+        return actual in value
+    if operator == "gt":
+        return actual > value
+    if operator == "gte":
+        return actual >= value
+    if operator == "lt":
+        return actual < value
+    if operator == "lte":
+        return actual <= value
+    raise ValueError("Unsupported filter {0}".format(condition))
+
+
+class SubgraphServer:
+    """Local stand-in of the hosted subgraphs, serving GraphQL queries over HTTP.
+    Requests are answered from recordings first, then from fixtures. Without fixtures, requests missing
+    from recordings are forwarded to upstream (if set) and recorded.
+    latency - mean seconds added to every response, with jitter as standard deviation
+    error_rate - share of requests failing with HTTP 503
+    rate_limit - requests per second above which requests fail with HTTP 429
+    """
+
+    def __init__(self, fixtures=None, recordings=None, upstream=None, latency=0, jitter=0, error_rate=0, rate_limit=None, seed=0):
+        self._resolvers = {name: Resolver(entities) for name, entities in fixtures.subgraphs.items()} if fixtures else {}
+        self._recordings = recordings
+        self._upstream = upstream
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._rate_limit = rate_limit
+        self._rng = random.Random(seed)
+        self._window = (0, 0)
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(PATH_PREFIX + "{name}", self._handle)
+        return app
+
+    async def _handle(self, request):
+        if self._latency or self._jitter:
+            await asyncio.sleep(max(0, self._rng.gauss(self._latency, self._jitter)))
+        if self._isRateLimited():
+            return web.json_response({"error": "Too many requests"}, status=429)
+        if self._rng.random() < self._error_rate:
+            return web.json_response({"error": "Injected error"}, status=503)
+
+        name = request.match_info["name"]
+        body = await request.json()
+        query = body["query"]
+        variables = body.get("variables") or {}
+
+        if self._recordings is not None:
+            response = self._recordings.get(name, query, variables)
+            if response is not None:
+                return web.json_response(response)
+
+        if name in self._resolvers:
+            result = await graphql(SCHEMA, query, root_value=self._resolvers[name], variable_values=variables)
+            response = {"data": result.data}
+            if result.errors:
+                response["errors"] = [error.formatted for error in result.errors]
+            return web.json_response(response)
+
+        if self._upstream is not None:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(self._upstream.rstrip("/") + PATH_PREFIX + name, json=body) as upstream_response:
+                    response = await upstream_response.json()
+            if self._recordings is not None and "errors" not in response:
+                self._recordings.put(name, query, variables, response)
+            return web.json_response(response)
+
+        return web.json_response({"errors": [{"message": "No fixture or recording for subgraph {0}".format(name)}]})
+
+    def _isRateLimited(self):
+        if self._rate_limit is None:
+            return False
+        second = int(time.monotonic())
+        window_second, count = self._window
+        count = count + 1 if window_second == second else 1
+        self._window = (second, count)
+        return count > self._rate_limit
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in of the Sushiswap subgraphs.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--generate", metavar="SCALE", help="serve synthetic data with this many pool transactions, ie. 100k")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures", help="serve fixtures from JSON file")
+    parser.add_argument("--save-fixtures", metavar="PATH", help="write generated fixtures to JSON file")
+    parser.add_argument("--recordings", metavar="DIR", help="serve recorded responses from folder")
+    parser.add_argument("--record", metavar="UPSTREAM", help="forward requests without fixtures to upstream, ie. https://api.thegraph.com, and record them")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--rate-limit", type=int, help="requests per second")
+    args = parser.parse_args()
+
+    if args.record and not args.recordings:
+        parser.error("--record needs --recordings folder")
+
+    fixtures = None
+    if args.fixtures:
+        fixtures = Fixtures.load(args.fixtures)
+    elif args.generate:
+        print("Generating {0} transactions...".format(args.generate))
+        fixtures = Fixtures.fromSyntheticData(synthetic_data.generate(synthetic_data.parse_scale(args.generate), args.seed))
+    if fixtures is not None and args.save_fixtures:
+        fixtures.save(args.save_fixtures)
+
+    server = SubgraphServer(
+        fixtures, Recordings(args.recordings) if args.recordings else None, args.record,
+        args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate, args.rate_limit, args.seed)
+
+    print("Point the collector at the stand-in with:")
+    print("  export SUSHISWAP_ENDPOINT=http://{0}:{1}{2}sushiswap".format(args.host, args.port, PATH_PREFIX))
+    print("  export SUSHISWAP_FARMS_ENDPOINT=http://{0}:{1}{2}sushiswap-farms".format(args.host, args.port, PATH_PREFIX))
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
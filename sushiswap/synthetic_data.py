@@ -0,0 +1,219 @@
+import random
+
+from position_handler import MASTERCHEFS, WETH
+from price_helper import USDC, USDC_ETH_PAIR
+
+SUSHI = "0x6b3595068778dd592e39a122f4f5a5cf09c90fe2"
+SUSHI_WETH_PAIR = "0x795065dcc9f64b5614c407a6efdc400da6221fb0"
+SUSHI_PRICE_IN_ETH = 0.004
+
+FIRST_BLOCK = 11000000
+FIRST_TIMESTAMP = 1603000000
+BLOCK_TIME = 13
+# Blocks over which positions are opened
+BLOCK_SPAN = 2000000
+# Positions stay open at least a day, so they are not skipped as same day positions
+MIN_POSITION_BLOCKS = 7000
+MAX_POSITION_BLOCKS = 200000
+# Average number of blocks between snapshots of a market
+SNAPSHOT_INTERVAL = 500
+
+# Share of pools with a MasterChef farm, and of positions in those pools which go through the farm
+FARMED_POOLS = 0.5
+FARMED_POSITIONS = 0.5
+# Share of positions whose LP tokens are transferred to another account, they are dropped when merging
+TRANSFERRED_POSITIONS = 0.05
+
+SCALE_SUFFIXES = {"k": 1000, "m": 1000000}
+
+
+class SyntheticData:
+    """Seeded synthetic subgraph data, in the shapes returned by the queries in queries/.
+    positions - rows of get_all_raw_closed_positions.graphql, ordered by ID
+    farm_positions - rows of the same query on the farms subgraph
+    markets - dict where key is pool and value (tokenA, tokenB)
+    farms - dict where key is LP token (pool) and value farm market ID, as returned by SushiswapFarmsClient.getAllMarkets
+    snapshots - dict where key is market and value rows of market_snapshots_range.graphql
+    tokens - dict where key is token and value dict with name, symbol and decimals
+    """
+
+    def __init__(self):
+        self.positions = []
+        self.farm_positions = []
+        self.markets = {}
+        self.farms = {}
+        self.snapshots = {}
+        self.tokens = {}
+
+    def transactionCount(self):
+        return sum(len(position["history"]) for position in self.positions)
+
+
+def generate(transactions, seed=0, markets=20):
+    """Generate data with about given number of pool transactions, the same data for the same seed."""
+    return _Generator(random.Random(seed)).generate(transactions, markets)
+
+
+def parse_scale(scale):
+    """Parse number of transactions, ie. '10k' or '10m'."""
+
+    multiplier = SCALE_SUFFIXES.get(scale[-1].lower())
+    if multiplier is None:
+        return int(scale)
+    return int(float(scale[:-1]) * multiplier)
+
+
+class _Generator:
+
+    def __init__(self, rng):
+        self._rng = rng
+        self._data = SyntheticData()
+        self._counters = {}
+        self._tx_count = 0
+
+    def generate(self, transactions, markets):
+        data = self._data
+        data.tokens[WETH] = {"name": "Wrapped Ether", "symbol": "WETH", "decimals": 18}
+        data.tokens[USDC] = {"name": "USD Coin", "symbol": "USDC", "decimals": 6}
+        data.tokens[SUSHI] = {"name": "SushiToken", "symbol": "SUSHI", "decimals": 18}
+        data.markets[USDC_ETH_PAIR] = (USDC, WETH)
+
+        # price of every token in ETH at the first block
+        prices = {USDC: 1 / 2000}
+        for i in range(markets):
+            token = self._address()
+            data.tokens[token] = {"name": "Token {0}".format(i), "symbol": "TKN{0}".format(i), "decimals": self._rng.choice([6, 8, 18])}
+            data.markets[self._address()] = (token, WETH)
+            prices[token] = self._rng.lognormvariate(-6, 2)
+
+        pools = [market for market in data.markets if market != USDC_ETH_PAIR]
+        for i, pool in enumerate(pools):
+            if self._rng.random() < FARMED_POOLS:
+                data.farms[pool] = "{0}-{1}".format(MASTERCHEFS[0], i)
+
+        accounts = [self._address() for _ in range(max(1, transactions // 20))]
+        while self._tx_count < transactions:
+            account = self._rng.choice(accounts)
+            pool = self._rng.choice(pools)
+            start_block = FIRST_BLOCK + self._rng.randrange(BLOCK_SPAN)
+
+            if pool in data.farms and self._rng.random() < FARMED_POSITIONS:
+                self._farmedPosition(account, pool, start_block)
+            else:
+                self._position(account, pool, start_block)
+
+        last_block = FIRST_BLOCK + BLOCK_SPAN + MAX_POSITION_BLOCKS
+        for market, (token, _) in data.markets.items():
+            data.snapshots[market] = self._snapshots(market, token, prices[token], last_block)
+
+        # pair pricing the rewards, it has no positions
+        data.markets[SUSHI_WETH_PAIR] = (SUSHI, WETH)
+        data.snapshots[SUSHI_WETH_PAIR] = self._snapshots(SUSHI_WETH_PAIR, SUSHI, SUSHI_PRICE_IN_ETH, last_block)
+
+        data.positions.sort(key=lambda position: position["id"])
+        data.farm_positions.sort(key=lambda position: position["id"])
+        return data
+
+    def _position(self, account, pool, block):
+        """Position invested one or more times and redeemed, or transferred out to another account."""
+
+        history = [self._transaction("INVEST", block, self._inputAmounts(pool))]
+        for _ in range(self._rng.randrange(3)):
+            block += self._rng.randrange(1, MIN_POSITION_BLOCKS)
+            history.append(self._transaction("INVEST", block, self._inputAmounts(pool)))
+
+        block += self._rng.randrange(MIN_POSITION_BLOCKS, MAX_POSITION_BLOCKS)
+        if self._rng.random() < TRANSFERRED_POSITIONS:
+            history.append(self._transaction("TRANSFER_OUT", block, self._lpAmount(pool), transferred_to=self._address()))
+        else:
+            history.append(self._transaction("REDEEM", block, self._inputAmounts(pool)))
+
+        self._addPosition(self._data.positions, account, pool, history)
+
+    def _farmedPosition(self, account, pool, block):
+        """Position whose LP tokens are staked in MasterChef: pool position closed by the transfer to the farm,
+        farm position claiming rewards when unstaking and pool position opened by the transfer back and redeemed.
+        """
+
+        farm_address, farm_id = self._data.farms[pool].split("-")
+        stake_block = block + self._rng.randrange(1, MIN_POSITION_BLOCKS)
+        unstake_block = stake_block + self._rng.randrange(MIN_POSITION_BLOCKS, MAX_POSITION_BLOCKS)
+        redeem_block = unstake_block + self._rng.randrange(1, MIN_POSITION_BLOCKS)
+        stake_hash = self._hash()
+        unstake_hash = self._hash()
+
+        self._addPosition(self._data.positions, account, pool, [
+            self._transaction("INVEST", block, self._inputAmounts(pool)),
+            self._transaction("TRANSFER_OUT", stake_block, self._lpAmount(pool), transferred_to=farm_address, tx_hash=stake_hash),
+        ])
+        self._addPosition(self._data.positions, account, pool, [
+            self._transaction("TRANSFER_IN", unstake_block, self._lpAmount(pool), transferred_from=farm_address, tx_hash=unstake_hash),
+            self._transaction("REDEEM", redeem_block, self._inputAmounts(pool)),
+        ])
+
+        rewards = ["{0}|SUSHI|{1}".format(SUSHI, self._rng.randrange(10 ** 15, 10 ** 21))]
+        self._addPosition(self._data.farm_positions, account, farm_address + "-" + farm_id, [
+            self._transaction("INVEST", stake_block, self._lpAmount(pool), ["{0}|SUSHI|0".format(SUSHI)], tx_hash=stake_hash),
+            self._transaction("REDEEM", unstake_block, self._lpAmount(pool), rewards, tx_hash=unstake_hash),
+        ], count=False)
+
+    def _addPosition(self, positions, account, market, history, count=True):
+        key = (account, market)
+        counter = self._counters.get(key, 0)
+        self._counters[key] = counter + 1
+
+        positions.append({
+            "id": "{0}-{1}-INVESTMENT-{2}".format(account, market, counter),
+            "accountAddress": account,
+            "history": history,
+        })
+        if count:
+            self._tx_count += len(history)
+
+    def _transaction(self, transaction_type, block, input_amounts, reward_amounts=None, transferred_to=None, transferred_from=None, tx_hash=None):
+        tx_hash = tx_hash or self._hash()
+        return {"transaction": {
+            "id": tx_hash + "-" + str(self._rng.randrange(200)),
+            "blockNumber": str(block),
+            "timestamp": str(FIRST_TIMESTAMP + (block - FIRST_BLOCK) * BLOCK_TIME),
+            "inputTokenAmounts": input_amounts,
+            "rewardTokenAmounts": reward_amounts,
+            "transactionType": transaction_type,
+            "transferredTo": transferred_to,
+            "transferredFrom": transferred_from,
+            "transactionHash": tx_hash,
+        }}
+
+    def _inputAmounts(self, pool):
+        return ["{0}|{1}|{2}".format(token, self._data.tokens[token]["symbol"], self._amount(token)) for token in self._data.markets[pool]]
+
+    def _lpAmount(self, pool):
+        return ["{0}|SLP|{1}".format(pool, self._rng.randrange(10 ** 15, 10 ** 20))]
+
+    def _amount(self, token):
+        return int(self._rng.uniform(0.01, 100) * 10 ** self._data.tokens[token]["decimals"])
+
+    def _snapshots(self, market, token, price, last_block):
+        """Snapshots of a pair of token and WETH whose price in ETH walks randomly."""
+
+        tokens = sorted([token, WETH])
+        decimals = self._data.tokens[token]["decimals"]
+        snapshots = []
+        block = FIRST_BLOCK - SNAPSHOT_INTERVAL
+        while block <= last_block:
+            weth_reserve = self._rng.uniform(1000, 100000)
+            reserves = {WETH: int(weth_reserve * 10 ** 18), token: int(weth_reserve / price * 10 ** decimals)}
+            snapshots.append({
+                "id": "{0}-{1}".format(market, block),
+                "inputTokenBalances": ["{0}|{1}|{2}".format(t, self._data.tokens[t]["symbol"], reserves[t]) for t in tokens],
+                "blockNumber": str(block),
+            })
+            price *= self._rng.lognormvariate(0, 0.01)
+            block += self._rng.randrange(1, 2 * SNAPSHOT_INTERVAL)
+        return snapshots
+
+    def _address(self):
+        return "0x{0:040x}".format(self._rng.getrandbits(160))
+
+    def _hash(self):
+        return "0x{0:064x}".format(self._rng.getrandbits(256))
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import threading
+
+TOKEN_DB = "cache/tokens.sqlite"
+
+# Max number of SQL variables in a single statement
+CHUNK_SIZE = 900
+
+class TokenStore:
+    """Token metadata (name, symbol, decimals) and input tokens of markets, stored in SQLite.
+    Tokens which don't exist in the subgraph are stored with empty metadata, so they are not queried again.
+    """
+
+    def __init__(self, path=TOKEN_DB):
+        self._path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def getTokens(self, addresses):
+        """Return dict where key is token address and value dict with name, symbol and decimals.
+        Addresses which are not stored are left out.
+        """
+
+        addresses = list(addresses)
+        tokens = {}
+        with self._lock:
+            connection = self._connect()
+            for i in range(0, len(addresses), CHUNK_SIZE):
+                chunk = addresses[i:i+CHUNK_SIZE]
+                rows = connection.execute(
+                    "SELECT id, name, symbol, decimals FROM tokens WHERE id IN ({0})".format(",".join("?" * len(chunk))), chunk)
+                for address, name, symbol, decimals in rows:
+                    tokens[address] = {"name": name, "symbol": symbol, "decimals": decimals}
+        return tokens
+
+    def putTokens(self, tokens):
+        """Store token metadata given as dict, as returned by getTokens. Value None marks token which doesn't exist."""
+
+        rows = []
+        for address, token in tokens.items():
+            token = token or {}
+            rows.append((address, token.get("name"), token.get("symbol"), token.get("decimals")))
+
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO tokens (id, name, symbol, decimals) VALUES (?, ?, ?, ?)", rows)
+
+    def putMarkets(self, markets):
+        """Store input tokens of markets, given as dict where key is market and value (tokenA, tokenB)."""
+
+        rows = [(market, tokenA, tokenB) for market, (tokenA, tokenB) in markets.items()]
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO markets (id, tokenA, tokenB) VALUES (?, ?, ?)", rows)
+
+    def getMarketNames(self):
+        """Return dict where key is market and value its name made of input token symbols, ie. 'DAI_WETH'.
+        WETH comes last, the same as in names of pools in data_collector.
+        """
+
+        with self._lock:
+            rows = self._connect().execute("""
+                SELECT markets.id, a.symbol, b.symbol FROM markets
+                JOIN tokens a ON a.id = markets.tokenA
+                JOIN tokens b ON b.id = markets.tokenB
+                WHERE a.symbol IS NOT NULL AND b.symbol IS NOT NULL""").fetchall()
+        return {market: (symbolB + "_" + symbolA if symbolA == "WETH" else symbolA + "_" + symbolB) for market, symbolA, symbolB in rows}
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            self._connection = sqlite3.connect(self._path, timeout=60, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tokens (id TEXT PRIMARY KEY, name TEXT, symbol TEXT, decimals INTEGER)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS markets (id TEXT PRIMARY KEY, tokenA TEXT, tokenB TEXT)")
+        return self._connection
+
+
+token_store = TokenStore()
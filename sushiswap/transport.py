@@ -0,0 +1,159 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+from gql.transport.exceptions import TransportServerError
+
+from metrics import metrics, REQUESTS, RETRIES, ERRORS, BYTES, LATENCY
+
+# Retries of a failed request, with full jitter exponential backoff between BACKOFF_BASE and BACKOFF_MAX seconds
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Requests per second sent to a single endpoint, by all the processes together. Rate is halved when the indexer
+# answers 429 and grows back by RATE_INCREASE for every successful request.
+MAX_RATE = 20.0
+MIN_RATE = 0.5
+RATE_INCREASE = 0.1
+BURST = 20
+
+def is_retryable(error):
+    """Rate limiting, server errors, timeouts and dropped connections are worth another attempt."""
+
+    if isinstance(error, TransportServerError):
+        return error.code is None or error.code == 429 or error.code >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientError))
+
+def is_rate_limited(error):
+    return isinstance(error, TransportServerError) and error.code == 429
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry attempt (counted from 0), full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class ResponseSize:
+    """Bytes received for a request, filled in by the trace of the sessions' HTTP requests."""
+
+    def __init__(self):
+        self.bytes = None
+
+
+def response_size_trace():
+    """aiohttp trace config recording the size of responses of requests sent with a ResponseSize as trace_request_ctx.
+    Size is the response's Content-Length, or the length of the body when it has none (ie. chunked responses).
+    """
+
+    async def on_request_end(session, context, params):
+        if isinstance(context.trace_request_ctx, ResponseSize):
+            context.trace_request_ctx.bytes = params.response.content_length
+
+    async def on_response_chunk_received(session, context, params):
+        size = context.trace_request_ctx
+        if isinstance(size, ResponseSize) and size.bytes is None:
+            size.bytes = len(params.chunk)
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    trace.on_response_chunk_received.append(on_response_chunk_received)
+    return trace
+
+
+class TokenBucket:
+    """Async token bucket limiting the rate of requests to an endpoint.
+    Rate adapts to the indexer: halved on rate limiting, increased additively on success.
+    Used only from the connection pool's event loop, so it needs no locks.
+    """
+
+    def __init__(self, rate=MAX_RATE, burst=BURST):
+        self._max_rate = rate
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+        # token is taken right away, so concurrent requests queue up behind each other
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._rate)
+
+    def onSuccess(self):
+        self._rate = min(self._max_rate, self._rate + RATE_INCREASE)
+
+    def onRateLimited(self):
+        self._rate = max(MIN_RATE, self._rate / 2)
+        # drop the burst allowance, so the next requests wait for the new rate
+        self._tokens = min(self._tokens, 0)
+
+
+class Transport:
+    """Retrying, rate limited execution of subgraph requests, one token bucket per endpoint."""
+
+    def __init__(self, max_retries=MAX_RETRIES, max_rate=MAX_RATE, burst=BURST):
+        self._max_retries = max_retries
+        self._max_rate = max_rate
+        self._burst = burst
+        self._buckets = {}
+
+    def shareRateLimit(self, processes):
+        """Limit this process to its share of the endpoints' rate, when processes send requests at the same time."""
+
+        self._max_rate = MAX_RATE / processes
+        self._burst = max(1, BURST // processes)
+        self._buckets = {}
+
+    async def execute(self, endpoint, request, query=None, size=None):
+        """Await request(size) (a coroutine function sending one request), retrying it on retryable errors.
+        Requests, their latency and size are recorded in metrics under query.
+        size - ResponseSize the request fills in, holds the size of the successful response
+        """
+
+        if size is None:
+            size = ResponseSize()
+
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            bucket = self._buckets[endpoint] = TokenBucket(self._max_rate, self._burst)
+
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            metrics.increment(REQUESTS, query=query)
+            start_time = time.monotonic()
+            size.bytes = None
+            try:
+                response = await request(size)
+            except Exception as error:
+                metrics.observe(LATENCY, time.monotonic() - start_time, query=query)
+                if not is_retryable(error) or attempt >= self._max_retries:
+                    metrics.increment(ERRORS, query=query)
+                    raise
+                metrics.increment(RETRIES, query=query)
+                if is_rate_limited(error):
+                    bucket.onRateLimited()
+                delay = backoff_delay(attempt)
+                print("Request to {0} failed ({1}), retry {2} in {3:.1f}s".format(endpoint, repr(error), attempt + 1, delay))
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            metrics.observe(LATENCY, time.monotonic() - start_time, query=query)
+            if size.bytes is not None:
+                metrics.increment(BYTES, size.bytes, query=query)
+            bucket.onSuccess()
+            return response
+
+
+transport = Transport()
+
+
+def share_rate_limit(processes):
+    """Initializer of worker processes, see Transport.shareRateLimit."""
+    transport.shareRateLimit(processes)